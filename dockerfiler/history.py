@@ -0,0 +1,104 @@
+import json
+import os
+import shlex
+import statistics
+import sys
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import dockerfiler.image_definition
+
+
+def get_step_source(
+    definition: dockerfiler.image_definition.ImageDefinition,
+) -> Tuple[str, str]:
+    """
+    What kind of work producing a tag from this definition involves, and what it's produced
+    from. Durations are recorded and estimated per (kind, repository, source).
+    """
+    if isinstance(definition, dockerfiler.image_definition.MirrorImageDefinition):
+        return "pull", definition.source_reference
+
+    if isinstance(definition, dockerfiler.image_definition.BuildImageDefinition):
+        return "build", definition.dockerfile_path
+
+    raise Exception(f"Unexpected image definition {definition}")
+
+
+class BuildHistory:
+    """
+    Local store of how long past builds, pulls and pushes took. It's a file of JSON lines,
+    appended to by the emitted script as each step finishes, e.g.
+
+        {"kind": "build", "repository": "myuser/tool1", "source": "tool1.Dockerfile", "seconds": 312}
+
+    Estimates are the median of the most recent samples for each (kind, repository, source).
+    """
+
+    path: str
+    durations: Dict[Tuple[str, str, str], List[float]]
+
+    # Only recent samples count, so that estimates follow changes to the Dockerfiles.
+    sample_count = 5
+
+    def __init__(self, path: str):
+        self.path = path
+        self.durations = {}
+        if not os.path.exists(path):
+            return
+
+        with open(path) as f:
+            for line_number, line in enumerate(f, start=1):
+                if line.strip() == "":
+                    continue
+
+                # History only affects ordering, so a bad line (e.g. a partial append from
+                # a killed run) is skipped rather than fatal.
+                try:
+                    record = json.loads(line)
+                    key = (record["kind"], record["repository"], record["source"])
+                    seconds = float(record["seconds"])
+                except Exception:
+                    print(
+                        f"Skipping malformed line {line_number} of build history {path}",
+                        file=sys.stderr,
+                    )
+                    continue
+
+                self.durations.setdefault(key, []).append(seconds)
+
+    def estimate(self, kind: str, repository: str, source: str = "") -> Optional[float]:
+        samples = self.durations.get((kind, repository, source))
+        if not samples:
+            return None
+
+        return statistics.median(samples[-self.sample_count :])
+
+    def print_timer_start(self) -> None:
+        print("dockerfiler_step_started=$(date +%s)")
+
+    def print_timer_end(self, kind: str, repository: str, source: str = "") -> None:
+        """
+        Emit a command appending the time elapsed since `print_timer_start` to the history file.
+        """
+        record_format = shlex.quote(
+            '{"kind": "%s", "repository": "%s", "source": "%s", "seconds": %d}\\n'
+        )
+        arguments = " ".join(shlex.quote(x) for x in [kind, repository, source])
+        print(
+            f"printf {record_format} {arguments} "
+            f"$(( $(date +%s) - dockerfiler_step_started )) >> {shlex.quote(self.path)}"
+        )
+
+
+def format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "unknown"
+
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    if minutes == 0:
+        return f"{seconds}s"
+
+    return f"{minutes}m{seconds:02d}s"
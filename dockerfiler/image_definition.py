@@ -1,39 +1,111 @@
+import concurrent.futures
+import fnmatch
+import hashlib
 import json
+import os
+import re
+from typing import Any
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Set
+from typing import Tuple
 
 import schema
 
+import dockerfiler.tag_selector
+
 tag_schema = {str: schema.Or(None, {str: str,})}
 
+tag_selector_schema = schema.And(
+    {
+        schema.Optional("pattern"): schema.And(str, re.compile),
+        # `parse_range` raises on an invalid range. Its result may be empty (e.g. for `*`), so
+        # it can't be the validator itself.
+        schema.Optional("semver"): schema.And(
+            str, lambda x: dockerfiler.tag_selector.parse_range(x) is not None
+        ),
+        schema.Optional("limit"): schema.And(int, lambda x: x > 0),
+    },
+    lambda x: "pattern" in x or "semver" in x,
+)
+
+build_definition_schema = {
+    "type": "build",
+    "dockerfile_path": str,
+    schema.Optional("build_context"): str,
+    schema.Optional("platforms"): [
+        schema.Regex(r"^[a-z0-9]+/[a-z0-9_]+(/[a-z0-9]+)?$")
+    ],
+    "tags": tag_schema,
+}
+
+mirror_definition_schema = schema.And(
+    {
+        "type": "mirror",
+        "source_reference": str,
+        schema.Optional("tags"): tag_schema,
+        schema.Optional("tag_selector"): tag_selector_schema,
+    },
+    lambda x: "tags" in x or "tag_selector" in x,
+)
+
+# Validates the shape of a manifest without constructing image definitions. This is what gets
+# stored in the manifest cache, so that a cache hit can skip straight to construction.
+manifest_schema = schema.Schema(
+    {str: [schema.Or(build_definition_schema, mirror_definition_schema)]}
+)
+
+
+def make_build_image_definition(x: Dict) -> "BuildImageDefinition":
+    return BuildImageDefinition(
+        dockerfile_path=x["dockerfile_path"],
+        build_context=x.get("build_context"),
+        tags=x["tags"],
+        platforms=x.get("platforms"),
+    )
+
+
+def make_mirror_image_definition(x: Dict) -> "MirrorImageDefinition":
+    tag_selector = None
+    if "tag_selector" in x:
+        tag_selector = dockerfiler.tag_selector.TagSelector(
+            pattern=x["tag_selector"].get("pattern"),
+            semver=x["tag_selector"].get("semver"),
+            limit=x["tag_selector"].get("limit"),
+        )
+
+    return MirrorImageDefinition(
+        source_reference=x["source_reference"],
+        tags=dict(x.get("tags") or {}),
+        tag_selector=tag_selector,
+    )
+
+
+def make_image_definitions(manifest: Dict) -> Dict[str, List["ImageDefinition"]]:
+    """
+    Construct image definitions from a manifest which has already been validated against
+    `manifest_schema`.
+    """
+    constructors = {
+        "build": make_build_image_definition,
+        "mirror": make_mirror_image_definition,
+    }
+    return {
+        repository: [constructors[x["type"]](x) for x in definitions]
+        for repository, definitions in manifest.items()
+    }
+
+
 image_definition_schema = schema.Schema(
     {
         str: [
             schema.Or(
                 schema.And(
-                    {
-                        "type": "build",
-                        "dockerfile_path": str,
-                        schema.Optional("build_context"): str,
-                        "tags": tag_schema,
-                    },
-                    schema.Use(
-                        lambda x: BuildImageDefinition(
-                            dockerfile_path=x.get("dockerfile_path"),
-                            build_context=x.get("build_context"),
-                            tags=x.get("tags"),
-                        )
-                    ),
+                    build_definition_schema, schema.Use(make_build_image_definition)
                 ),
                 schema.And(
-                    {"type": "mirror", "source_reference": str, "tags": tag_schema,},
-                    schema.Use(
-                        lambda x: MirrorImageDefinition(
-                            source_reference=x.get("source_reference"),
-                            tags=x.get("tags"),
-                        )
-                    ),
+                    mirror_definition_schema, schema.Use(make_mirror_image_definition)
                 ),
             )
         ]
@@ -48,46 +120,218 @@ class ImageDefinition:
     def __init__(self, tags: Tags):
         self.tags = tags
 
-    def print_instructions(self, tag: str, destination: str) -> None:
+    def print_instructions(
+        self, tag: str, destination: str, platform: Optional[str] = None
+    ) -> None:
         pass
 
+    def get_base_images(self, tag: str) -> List[str]:
+        """
+        Images that producing `tag` pulls in, as far as we can tell without running anything.
+        """
+        return []
+
+    def describe(self, tag: str) -> Tuple:
+        """
+        Everything in the manifest that determines how `tag` is produced, for comparing
+        manifests.
+        """
+        return ()
+
 
 class MirrorImageDefinition(ImageDefinition):
-    def __init__(self, source_reference: str, tags: Tags):
+    def __init__(
+        self,
+        source_reference: str,
+        tags: Tags,
+        tag_selector: Optional[dockerfiler.tag_selector.TagSelector] = None,
+    ):
         super().__init__(tags=tags)
         self.source_reference = source_reference
+        self.tag_selector = tag_selector
 
-    def print_instructions(self, tag: str, destination: str) -> None:
+    def add_selected_tags(self, source_tags: List[str]) -> None:
+        """
+        Add the tags picked by the tag selector from those present upstream (`source_tags`)
+        to the explicitly listed tags.
+        """
+        if self.tag_selector is None:
+            return
+
+        for tag in self.tag_selector.select(source_tags):
+            self.tags.setdefault(tag, None)
+
+    def print_instructions(
+        self, tag: str, destination: str, platform: Optional[str] = None
+    ) -> None:
         source = f"{self.source_reference}:{tag}"
         print(f"docker pull {source}")
         print(f"docker tag {source} {destination}")
 
+    def get_base_images(self, tag: str) -> List[str]:
+        return [f"{self.source_reference}:{tag}"]
+
+    def describe(self, tag: str) -> Tuple:
+        return ("mirror", self.source_reference)
+
 
 class BuildImageDefinition(ImageDefinition):
     def __init__(
-        self, dockerfile_path: str, tags: Tags, build_context: Optional[str] = None,
+        self,
+        dockerfile_path: str,
+        tags: Tags,
+        build_context: Optional[str] = None,
+        platforms: Optional[List[str]] = None,
     ):
         super().__init__(tags=tags)
         self.dockerfile_path = dockerfile_path
         self.build_context = build_context or "."
+        self.platforms = platforms or []
 
-    def print_instructions(self, tag: str, destination: str) -> None:
+    def get_build_arguments(self, tag: str) -> Dict[str, str]:
         build_arguments = {"TAG": tag}
         tag_build_arguments = self.tags.get(tag)
         if tag_build_arguments is not None:
             build_arguments.update(tag_build_arguments)
 
+        return build_arguments
+
+    def describe(self, tag: str) -> Tuple:
+        return (
+            "build",
+            self.dockerfile_path,
+            self.build_context,
+            tuple(sorted(self.get_build_arguments(tag).items())),
+            tuple(self.platforms),
+        )
+
+    def print_instructions(
+        self, tag: str, destination: str, platform: Optional[str] = None
+    ) -> None:
+        build_arguments = self.get_build_arguments(tag)
         build_arguments_string = " ".join(
             [f'--build-arg {k}="{v}"' for k, v in build_arguments.items()]
         )
+        platform_string = f"--platform {platform} " if platform is not None else ""
         print(
-            f"docker build -t {destination} -f {self.dockerfile_path} {build_arguments_string} {self.build_context}"
+            f"docker build {platform_string}-t {destination} -f {self.dockerfile_path} {build_arguments_string} {self.build_context}"
         )
 
+    def get_base_images(self, tag: str) -> List[str]:
+        """
+        Images named in the Dockerfile's `FROM` instructions, with the tag's build arguments
+        (and defaults of `ARG`s declared before the first `FROM`) substituted. References to
+        earlier build stages and `scratch` are left out.
+
+        Dockerfiler doesn't otherwise need access to the Dockerfiles, so if the Dockerfile isn't
+        readable from here, this is empty.
+        """
+        if not os.path.isfile(self.dockerfile_path):
+            return []
+
+        with open(self.dockerfile_path) as f:
+            # Join continuation lines so that each instruction is on one line.
+            instructions = re.sub(r"\\\r?\n", " ", f.read()).splitlines()
+
+        build_arguments = self.get_build_arguments(tag)
+        arguments: Dict[str, str] = {}
+        stage_names = set()
+        base_images: List[str] = []
+        in_stage = False
+        for instruction in instructions:
+            words = instruction.split()
+            if len(words) < 2:
+                continue
+
+            keyword = words[0].upper()
+            if keyword == "ARG":
+                # Only arguments declared before the first FROM can be used in FROM. Those
+                # declared within a stage are scoped to it.
+                if in_stage:
+                    continue
+
+                # One ARG instruction may declare several arguments, e.g. `ARG A=1 B=2`.
+                for word in words[1:]:
+                    name, separator, default = word.partition("=")
+                    if name in build_arguments:
+                        arguments[name] = build_arguments[name]
+                    elif separator != "":
+                        arguments[name] = default.strip("\"'")
+                    # Otherwise, the argument is unset, and references to it can't be resolved.
+            elif keyword == "FROM":
+                in_stage = True
+                words = [w for w in words[1:] if not w.startswith("--")]
+                if len(words) >= 3 and words[1].upper() == "AS":
+                    stage_names.add(words[2])
+
+                reference = words[0] if len(words) > 0 else ""
+                image = expand_arguments(reference, arguments)
+                if image is None:
+                    # Depends on something we can't know here, e.g. an undeclared argument.
+                    continue
+
+                if image in ("", "scratch") or image in stage_names:
+                    continue
+
+                if image not in base_images:
+                    base_images.append(image)
+
+        return base_images
+
+
+# `$VAR`, `${VAR}`, `${VAR:-default}` or `${VAR:+alternative}`
+argument_reference_pattern = re.compile(r"\$(?:(\w+)|\{(\w+)(?::([-+])([^}]*))?\})")
+
+
+def expand_arguments(value: str, arguments: Dict[str, str]) -> Optional[str]:
+    """
+    Substitute build arguments into `value` the way Docker does in a FROM instruction. Returns
+    None if a plain reference names an argument which isn't in `arguments`.
+    """
+    unknown = False
+
+    def replace(m: "re.Match[str]") -> str:
+        nonlocal unknown
+        name = m[1] or m[2]
+        modifier = m[3]
+        if modifier is None:
+            if name not in arguments:
+                unknown = True
+                return ""
+
+            return arguments[name]
+
+        # With a modifier, an unset argument is just empty.
+        current = arguments.get(name, "")
+        if modifier == "-":
+            return current or m[4]
+
+        return m[4] if current else ""
+
+    expanded = argument_reference_pattern.sub(replace, value)
+    return None if unknown else expanded
+
 
 class ImageDefinitions(dict):
+    index: Dict[str, Dict[str, ImageDefinition]]
+
     def __init__(self, image_definitions: Dict[str, List[ImageDefinition]]):
         self.update(image_definitions)
+        self.reindex()
+
+    def reindex(self) -> None:
+        """
+        Index definitions by repository and tag. If more than one definition in a repository
+        lists a tag, the first one wins. This needs to be called again if tags are added.
+        """
+        self.index = {}
+        for repository, definition_list in self.items():
+            definitions_by_tag: Dict[str, ImageDefinition] = {}
+            for definition in definition_list:
+                for tag in definition.tags:
+                    definitions_by_tag.setdefault(tag, definition)
+
+            self.index[repository] = definitions_by_tag
 
     @staticmethod
     def from_json(
@@ -103,21 +347,239 @@ class ImageDefinitions(dict):
             raise Exception("Failed parsing image definitions as JSON") from e
 
         validated_image_definitions = image_definition_schema.validate(parsed)
+        return ImageDefinitions.with_prefix(
+            validated_image_definitions, repository_prefix
+        )
+
+    @staticmethod
+    def from_directory(
+        directory: str,
+        repository_prefix: Optional[str] = None,
+        cache: Optional["ManifestCache"] = None,
+    ) -> "ImageDefinitions":
+        """
+        Load image definitions from every `.json` file under `directory`, each of which is a
+        manifest of its own. Files are validated in parallel, except for those which are
+        unchanged since they were last validated into `cache`. A repository may only be
+        defined in one file.
+        """
+        paths = []
+        for path, _, files in os.walk(directory):
+            paths += [os.path.join(path, x) for x in files if x.endswith(".json")]
+
+        paths.sort()
+        manifests_by_path: Dict[str, Dict] = {}
+        contents_by_path: Dict[str, bytes] = {}
+        for path in paths:
+            cached = cache.get(path) if cache is not None else None
+            if cached is not None:
+                manifests_by_path[path] = cached
+            else:
+                with open(path, "rb") as f:
+                    contents_by_path[path] = f.read()
+
+        if len(contents_by_path) > 1:
+            with concurrent.futures.ProcessPoolExecutor() as executor:
+                manifests_by_path.update(
+                    zip(
+                        contents_by_path.keys(),
+                        executor.map(
+                            validate_manifest_file,
+                            contents_by_path.keys(),
+                            contents_by_path.values(),
+                        ),
+                    )
+                )
+        else:
+            for path, contents in contents_by_path.items():
+                manifests_by_path[path] = validate_manifest_file(path, contents)
+
+        if cache is not None:
+            for path in contents_by_path:
+                cache.put(path, contents_by_path[path], manifests_by_path[path])
+
+            cache.save()
+
+        merged: Dict[str, List[ImageDefinition]] = {}
+        source_paths: Dict[str, str] = {}
+        for path in paths:
+            image_definitions = make_image_definitions(manifests_by_path[path])
+            for repository, definitions in image_definitions.items():
+                if repository in merged:
+                    raise Exception(
+                        f"Repository {repository} is defined in both {source_paths[repository]} and {path}"
+                    )
+
+                merged[repository] = definitions
+                source_paths[repository] = path
+
+        return ImageDefinitions.with_prefix(merged, repository_prefix)
+
+    @staticmethod
+    def with_prefix(
+        image_definitions: Dict[str, List[ImageDefinition]],
+        repository_prefix: Optional[str] = None,
+    ) -> "ImageDefinitions":
         if repository_prefix:
-            image_definitions = ImageDefinitions(
-                {
-                    f"{repository_prefix}{k}": v
-                    for k, v in validated_image_definitions.items()
-                }
+            return ImageDefinitions(
+                {f"{repository_prefix}{k}": v for k, v in image_definitions.items()}
             )
-        else:
-            image_definitions = ImageDefinitions(validated_image_definitions)
 
-        return image_definitions
+        return ImageDefinitions(image_definitions)
 
     def find_definition(self, repository: str, tag: str) -> ImageDefinition:
+        image_definition = self.index.get(repository, {}).get(tag)
+        if image_definition is not None:
+            return image_definition
+
+        # Without listing the upstream repository, any tag that a tag selector would pick is
+        # taken to be defined.
         for image_definition in self.get(repository) or []:
-            if tag in image_definition.tags:
+            if not isinstance(image_definition, MirrorImageDefinition):
+                continue
+
+            tag_selector = image_definition.tag_selector
+            if tag_selector is not None and tag_selector.matches(tag):
                 return image_definition
 
         raise Exception(f"No definition found for {repository}:{tag}")
+
+    def get_changed_tags(self, baseline: "ImageDefinitions") -> Dict[str, Set[str]]:
+        """
+        Tags, by repository, that are defined here but not in `baseline`, or are defined
+        differently. Tags picked by tag selectors aren't known in `baseline`, so they always
+        count as added.
+        """
+        changed_tags = {}
+        for repository, definitions_by_tag in self.index.items():
+            baseline_definitions_by_tag = baseline.index.get(repository, {})
+            changed = set()
+            for tag, definition in definitions_by_tag.items():
+                baseline_definition = baseline_definitions_by_tag.get(tag)
+                if baseline_definition is None:
+                    changed.add(tag)
+                elif baseline_definition.describe(tag) != definition.describe(tag):
+                    changed.add(tag)
+
+            if len(changed) > 0:
+                changed_tags[repository] = changed
+
+        return changed_tags
+
+    def select(self, target: str) -> List[Tuple[str, str]]:
+        """
+        Find the (repository, tag) pairs matching `target`, which is `repository:tag` or just
+        `repository` (meaning every tag), either part possibly being a glob pattern, e.g.
+        `team-x/*:2.*`.
+        """
+        repository_pattern, _, tag_pattern = target.partition(":")
+        if tag_pattern != "" and not is_glob_pattern(target):
+            # Raises if the tag isn't defined.
+            self.find_definition(repository_pattern, tag_pattern)
+            return [(repository_pattern, tag_pattern)]
+
+        if is_glob_pattern(repository_pattern):
+            repositories = [
+                x for x in self.index if fnmatch.fnmatchcase(x, repository_pattern)
+            ]
+        else:
+            repositories = (
+                [repository_pattern] if repository_pattern in self.index else []
+            )
+
+        selected = []
+        for repository in repositories:
+            for tag in self.index[repository]:
+                if fnmatch.fnmatchcase(tag, tag_pattern or "*"):
+                    selected.append((repository, tag))
+
+        if len(selected) == 0:
+            raise Exception(f"No definitions found matching {target}")
+
+        return selected
+
+
+def is_glob_pattern(target: str) -> bool:
+    return re.search(r"[*?[]", target) is not None
+
+
+def validate_manifest_file(path: str, contents: bytes) -> Dict:
+    """
+    Parse and validate one manifest file, returning the validated manifest for
+    `make_image_definitions`. This runs in worker processes when loading a directory of
+    manifests.
+    """
+    try:
+        parsed = json.loads(contents)
+    except Exception as e:
+        raise Exception(f"Failed parsing image definitions in {path} as JSON") from e
+
+    try:
+        return manifest_schema.validate(parsed)
+    except schema.SchemaError as e:
+        raise Exception(f"Invalid image definitions in {path}: {e}") from e
+
+
+class ManifestCache:
+    """
+    Validated manifests from manifest files, keyed by path and stored as JSON. An entry is used
+    as long as the file's modification time and size are unchanged or, failing that, its content
+    hash. A cache written by a different format version is ignored.
+    """
+
+    version = 1
+
+    path: str
+    entries: Dict[str, Dict[str, Any]]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        if not os.path.exists(path):
+            return
+
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+        except Exception:
+            return
+
+        if isinstance(cached, dict) and cached.get("version") == self.version:
+            self.entries = cached.get("entries") or {}
+
+    def get(self, path: str) -> Optional[Dict]:
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+
+        stat = os.stat(path)
+        if stat.st_mtime_ns == entry["mtime_ns"] and stat.st_size == entry["size"]:
+            return entry["manifest"]
+
+        with open(path, "rb") as f:
+            if hashlib.sha256(f.read()).hexdigest() != entry["sha256"]:
+                return None
+
+        entry.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        return entry["manifest"]
+
+    def put(self, path: str, contents: bytes, manifest: Dict) -> None:
+        stat = os.stat(path)
+        self.entries[path] = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": hashlib.sha256(contents).hexdigest(),
+            "manifest": manifest,
+        }
+
+    def save(self) -> None:
+        # Forget manifest files which have been deleted since they were cached.
+        self.entries = {
+            path: entry for path, entry in self.entries.items() if os.path.exists(path)
+        }
+        directory = os.path.dirname(self.path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+
+        with open(self.path, "w") as f:
+            json.dump({"version": self.version, "entries": self.entries}, f)
@@ -1,61 +1,376 @@
 import argparse
+import concurrent.futures
+import functools
 import os
 import sys
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
 
+import dockerfiler.history
 import dockerfiler.image_definition
+import dockerfiler.plan
 import dockerfiler.registries
 
 
-def print_instructions_for_tag(
-    definition: dockerfiler.image_definition.ImageDefinition,
+def resolve_tag_selectors(
+    registry: dockerfiler.registries.DockerRegistry,
+    image_definitions: dockerfiler.image_definition.ImageDefinitions,
+    cache: Optional[dockerfiler.registries.TagListCache] = None,
+) -> None:
+    """
+    Add the tags picked by mirror definitions' tag selectors. Each source repository is listed
+    once (concurrently with the others), unless it has a fresh listing in `cache`.
+    """
+    definitions = []
+    for definition_list in image_definitions.values():
+        for definition in definition_list:
+            if not isinstance(
+                definition, dockerfiler.image_definition.MirrorImageDefinition
+            ):
+                continue
+
+            if definition.tag_selector is not None:
+                definitions.append(definition)
+
+    if len(definitions) == 0:
+        return
+
+    source_tags: Dict[str, List[str]] = {}
+    sources_to_list = []
+    for source_reference in sorted({x.source_reference for x in definitions}):
+        cached = cache.get(source_reference) if cache is not None else None
+        if cached is not None:
+            source_tags[source_reference] = cached
+        else:
+            sources_to_list.append(source_reference)
+
+    print(
+        f"Listing tags of {len(sources_to_list)} upstream repositories for tag selectors...",
+        file=sys.stderr,
+    )
+
+    def list_source_tags(source_reference: str) -> List[str]:
+        source_registry, repository = dockerfiler.registries.get_source_registry(
+            source_reference, registry
+        )
+        return source_registry.list_tags_on_repository(repository)
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        listings = executor.map(list_source_tags, sources_to_list)
+        for source_reference, tags in zip(sources_to_list, listings):
+            source_tags[source_reference] = tags
+            if cache is not None:
+                cache.put(source_reference, tags)
+
+    if cache is not None:
+        cache.save()
+
+    for definition in definitions:
+        definition.add_selected_tags(source_tags[definition.source_reference])
+
+    image_definitions.reindex()
+
+
+def get_steps(
+    registry: dockerfiler.registries.DockerRegistry,
+    image_definitions: dockerfiler.image_definition.ImageDefinitions,
+    should_push=False,
+    changed_tags: Optional[Dict[str, Set[str]]] = None,
+) -> List[dockerfiler.plan.Step]:
+    """
+    Inspect the registry and make a step for each tag that's missing from it. If
+    `changed_tags` is given, only those tags (by repository) are considered, and other
+    repositories aren't inspected at all. Existing multi-platform tags are inspected
+    concurrently for missing platforms.
+    """
+    candidates = []
+    for repository, definition_list in image_definitions.items():
+        if changed_tags is not None and repository not in changed_tags:
+            continue
+
+        existing_tags = set(registry.list_tags_on_repository(repository))
+
+        for definition in definition_list:
+            for tag in definition.tags:
+                if changed_tags is not None and tag not in changed_tags[repository]:
+                    continue
+
+                candidates.append((repository, tag, definition, existing_tags))
+
+    to_inspect = [
+        (repository, tag, definition)
+        for repository, tag, definition, existing_tags in candidates
+        if tag in existing_tags and len(dockerfiler.plan.get_platforms(definition)) > 0
+    ]
+    present_platforms_by_tag: Dict[Tuple[str, str], Optional[Dict[str, str]]] = {}
+    if len(to_inspect) > 0:
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            inspections = executor.map(
+                lambda x: get_incomplete_platforms(registry, *x), to_inspect
+            )
+            for (repository, tag, _), present_platforms in zip(to_inspect, inspections):
+                present_platforms_by_tag[(repository, tag)] = present_platforms
+
+    steps = []
+    for repository, tag, definition, existing_tags in candidates:
+        present_platforms = None
+        if tag in existing_tags:
+            present_platforms = present_platforms_by_tag.get((repository, tag))
+            if present_platforms is None:
+                continue
+
+        steps += dockerfiler.plan.get_tag_steps(
+            repository=repository,
+            tag=tag,
+            definition=definition,
+            get_destination=functools.partial(
+                registry.get_full_image_reference, repository
+            ),
+            should_push=should_push,
+            existing_tags=existing_tags,
+            present_platforms=present_platforms,
+        )
+
+    return steps
+
+
+def get_incomplete_platforms(
+    registry: dockerfiler.registries.DockerRegistry,
+    repository: str,
     tag: str,
-    destination: str,
-    should_push: bool = False,
-):
-    definition.print_instructions(tag=tag, destination=destination)
+    definition: dockerfiler.image_definition.ImageDefinition,
+) -> Optional[Dict[str, str]]:
+    """
+    For a multi-platform tag that exists in the registry but lacks some of its platforms,
+    the platforms that it does have. None if nothing is missing (or if the registry can't
+    tell us, in which case the tag's presence is all that counts, as usual).
+    """
+    platforms = dockerfiler.plan.get_platforms(definition)
+    if len(platforms) == 0:
+        return None
+
+    present_platforms = registry.list_platforms_on_tag(repository, tag)
+    if present_platforms is None:
+        return None
+
+    missing_platforms = [
+        x
+        for x in platforms
+        if dockerfiler.registries.normalize_platform(x) not in present_platforms
+    ]
+    if len(missing_platforms) == 0:
+        return None
+
+    print(
+        f"{repository}:{tag} is missing platforms {missing_platforms}", file=sys.stderr
+    )
+    return present_platforms
+
+
+def get_remaining_steps(
+    registry: dockerfiler.registries.DockerRegistry,
+    steps: List[dockerfiler.plan.Step],
+    checkpoint: dockerfiler.plan.Checkpoint,
+) -> List[dockerfiler.plan.Step]:
+    """
+    Drop steps that completed according to the checkpoint, and re-check the registry for the
+    rest (only), in case a step got as far as pushing before failing.
+    """
+    remaining_steps = [x for x in steps if x.name not in checkpoint.completed]
+    existing_tags = {}
+    for repository in {x.repository for x in remaining_steps}:
+        existing_tags[repository] = set(registry.list_tags_on_repository(repository))
+
+    steps_to_do = []
+    for step in remaining_steps:
+        if step.destination_tag not in existing_tags[step.repository]:
+            steps_to_do.append(step)
+        elif isinstance(step, dockerfiler.plan.ManifestListStep):
+            # The tag may have existed with only some of its platforms all along.
+            present_platforms = get_incomplete_platforms(
+                registry, step.repository, step.tag, step.definition
+            )
+            if present_platforms is not None:
+                steps_to_do.append(step)
 
-    if should_push:
-        print(f"docker push {destination}")
+    return steps_to_do
+
+
+def order_steps(
+    steps: List[dockerfiler.plan.Step],
+    history: Optional[dockerfiler.history.BuildHistory] = None,
+) -> List[dockerfiler.plan.Step]:
+    dockerfiler.plan.find_dependencies(steps)
+    if history is not None:
+        for step in steps:
+            step.estimate(history)
+
+    return dockerfiler.plan.order_steps(steps)
+
+
+def print_steps(
+    steps: List[dockerfiler.plan.Step],
+    history: Optional[dockerfiler.history.BuildHistory] = None,
+    prefetch_parallelism: Optional[int] = None,
+    checkpoint: Optional[dockerfiler.plan.Checkpoint] = None,
+    platform_contexts: Optional[Dict[str, str]] = None,
+) -> None:
+    if history is not None:
+        dockerfiler.plan.print_estimates(steps)
+
+    if prefetch_parallelism is not None:
+        dockerfiler.plan.print_prefetch(
+            dockerfiler.plan.get_prefetch_images(steps),
+            prefetch_parallelism,
+            platform_contexts=platform_contexts,
+        )
+
+    for step in steps:
+        docker_context = None
+        if step.platform is not None:
+            docker_context = (platform_contexts or {}).get(step.platform)
+
+        step.print_instructions(history=history, docker_context=docker_context)
+        if checkpoint is not None:
+            checkpoint.print_step_completed(step)
 
 
 def run(
     registry: dockerfiler.registries.DockerRegistry,
     image_definitions: dockerfiler.image_definition.ImageDefinitions,
     should_push=False,
+    history: Optional[dockerfiler.history.BuildHistory] = None,
+    plan_path: Optional[str] = None,
+    checkpoint_path: Optional[str] = None,
+    resume=False,
+    prefetch_parallelism: Optional[int] = None,
+    tag_list_cache: Optional[dockerfiler.registries.TagListCache] = None,
+    baseline: Optional[dockerfiler.image_definition.ImageDefinitions] = None,
+    platform_contexts: Optional[Dict[str, str]] = None,
 ) -> None:
-    created_repositories = registry.create_repositories_if_necessary(
-        list(image_definitions.keys())
-    )
+    """
+    If a `baseline` manifest (one that has already been applied) is given, only tags that
+    were added or changed since then are checked against the registry.
+    """
+    resolve_tag_selectors(registry, image_definitions, cache=tag_list_cache)
+
+    checkpoint = None
+    if checkpoint_path is not None:
+        checkpoint = dockerfiler.plan.Checkpoint(checkpoint_path)
+
+    planned_steps = None
+    repositories = list(image_definitions.keys())
+    changed_tags = None
+    if baseline is not None and not resume:
+        changed_tags = image_definitions.get_changed_tags(baseline)
+        repositories = list(changed_tags.keys())
+        print(
+            f"{len(repositories)} of {len(image_definitions)} repositories changed since "
+            "the baseline manifest",
+            file=sys.stderr,
+        )
+
+    if resume:
+        if plan_path is None or checkpoint is None:
+            raise Exception("Resuming requires a plan file and a checkpoint file")
+
+        planned_steps = dockerfiler.plan.load_plan(
+            plan_path, image_definitions, registry
+        )
+        repositories = sorted({x.repository for x in planned_steps})
+
+    created_repositories = registry.create_repositories_if_necessary(repositories)
     if created_repositories is not None and len(created_repositories) > 0:
         print(f"Created repositories {created_repositories}", file=sys.stderr)
 
     # Fail immediately if any build or push fails. This script's output typically gets piped to bash.
     print("set -ex")
 
-    print(
-        "Inspecting existing images to know what needs to be built...", file=sys.stderr
+    if planned_steps is not None and checkpoint is not None:
+        print(
+            f"Resuming plan {plan_path}: {len(checkpoint.completed)} step(s) completed, "
+            "checking the rest against the registry...",
+            file=sys.stderr,
+        )
+        steps = get_remaining_steps(registry, planned_steps, checkpoint)
+        if history is not None:
+            for step in steps:
+                step.estimate(history)
+    else:
+        print(
+            "Inspecting existing images to know what needs to be built...",
+            file=sys.stderr,
+        )
+        steps = order_steps(
+            get_steps(
+                registry,
+                image_definitions,
+                should_push=should_push,
+                changed_tags=changed_tags,
+            ),
+            history=history,
+        )
+        if plan_path is not None:
+            dockerfiler.plan.save_plan(plan_path, steps)
+
+        # Completed steps from any earlier plan don't apply to this one.
+        if checkpoint is not None:
+            checkpoint.print_reset()
+
+    print_steps(
+        steps,
+        history=history,
+        prefetch_parallelism=prefetch_parallelism,
+        checkpoint=checkpoint,
+        platform_contexts=platform_contexts,
     )
-    for repository, definition_list in image_definitions.items():
-        existing_tags = registry.list_tags_on_repository(repository)
 
-        for definition in definition_list:
-            tags_to_do = set(definition.tags) - set(existing_tags)
-            if len(tags_to_do) == 0:
-                continue
 
-            for tag in tags_to_do:
-                print_instructions_for_tag(
-                    definition=definition,
-                    tag=tag,
-                    destination=registry.get_full_image_reference(repository, tag),
-                    should_push=should_push,
-                )
+def run_targets(
+    image_definitions: dockerfiler.image_definition.ImageDefinitions,
+    targets: List[str],
+    history: Optional[dockerfiler.history.BuildHistory] = None,
+    prefetch_parallelism: Optional[int] = None,
+    platform_contexts: Optional[Dict[str, str]] = None,
+) -> None:
+    """
+    Emit one plan for everything matching `targets` (see `ImageDefinitions.select`), tagged
+    locally and without consulting the registry.
+    """
+    selected: Dict[Tuple[str, str], None] = {}
+    for target in targets:
+        selected.update(dict.fromkeys(image_definitions.select(target)))
+
+    steps = []
+    for repository, tag in selected:
+        steps += dockerfiler.plan.get_tag_steps(
+            repository=repository,
+            tag=tag,
+            definition=image_definitions.find_definition(repository, tag),
+            get_destination=functools.partial("{}:{}".format, repository),
+        )
+
+    print("set -ex")
+    print_steps(
+        order_steps(steps, history=history),
+        history=history,
+        prefetch_parallelism=prefetch_parallelism,
+        platform_contexts=platform_contexts,
+    )
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "--target", help="Only build a specific image:tag. Useful for experimentation."
+        "--target",
+        nargs="+",
+        action="extend",
+        help="Only build specific image:tag targets, without consulting the registry. Useful "
+        "for experimentation. Either part may be a glob pattern (e.g. `team-x/*:2.*`), and "
+        "the tag may be omitted to mean every tag",
     )
     parser.add_argument(
         "--push",
@@ -65,7 +380,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--registry",
         help="Registry specification. Omit or `dockerhub` for Docker Hub. "
-        "Otherwise, `artifactory://<host>` or `ecr://<host>`",
+        "Otherwise, `artifactory://<host>`, `ecr://<host>` or `oci://<host>`",
     )
     parser.add_argument(
         "--registry-username",
@@ -81,20 +396,116 @@ if __name__ == "__main__":
         "--repository-prefix",
         help="Prefix to put on all repository names, e.g. `dockerhubusername/`",
     )
+    parser.add_argument(
+        "--manifest-dir",
+        help="Read the manifest from every `.json` file in this directory (recursively) "
+        "instead of from stdin",
+    )
+    parser.add_argument(
+        "--manifest-cache-file",
+        help="With --manifest-dir, cache validated manifest files here, so that unchanged "
+        "files aren't validated again",
+    )
+    parser.add_argument(
+        "--baseline-manifest",
+        help="Manifest (JSON file) that has already been applied. Only repositories and "
+        "tags that were added or changed since then are checked against the registry",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="With --baseline-manifest, ignore the baseline and check everything against the "
+        "registry",
+    )
+    parser.add_argument(
+        "--history-file",
+        help="File recording how long past builds, pulls and pushes took. If present, the "
+        "emitted script appends to it, and steps are ordered to start long work early",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        metavar="PARALLELISM",
+        help="Before any builds, pull the base images of the Dockerfiles (when readable) and "
+        "the mirror sources, up to this many at a time",
+    )
+    parser.add_argument(
+        "--tag-cache-file",
+        help="File caching tag listings of upstream repositories, for mirror definitions "
+        "with a tag selector",
+    )
+    parser.add_argument(
+        "--tag-cache-max-age",
+        type=int,
+        default=3600,
+        help="Seconds that cached upstream tag listings are used for (default 3600)",
+    )
+    parser.add_argument(
+        "--platform-context",
+        action="append",
+        default=[],
+        metavar="PLATFORM=CONTEXT",
+        help="Build (and push) images for this platform of multi-platform builds with this "
+        "Docker context, e.g. `linux/arm64=arm-builder` for a native builder. Repeatable",
+    )
+    parser.add_argument(
+        "--plan-file",
+        help="File to save the plan (the ordered list of steps) to, for use with --resume",
+    )
+    parser.add_argument(
+        "--checkpoint-file",
+        help="File that the emitted script records completed steps in. Defaults to the plan "
+        "file with `.checkpoint` appended",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Instead of inspecting the registry for everything, continue the saved plan: skip "
+        "steps recorded in the checkpoint and re-check only the remaining tags",
+    )
     args = parser.parse_args()
+    if args.prefetch is not None and args.prefetch < 1:
+        parser.error("--prefetch must be at least 1")
+
     should_push = args.push
-    target = args.target
 
-    image_definitions = dockerfiler.image_definition.ImageDefinitions.from_json(
-        image_definitions_json=sys.stdin.read(),
-        repository_prefix=args.repository_prefix,
-    )
+    if args.manifest_dir:
+        cache = None
+        if args.manifest_cache_file:
+            cache = dockerfiler.image_definition.ManifestCache(args.manifest_cache_file)
+
+        image_definitions = dockerfiler.image_definition.ImageDefinitions.from_directory(
+            directory=args.manifest_dir,
+            repository_prefix=args.repository_prefix,
+            cache=cache,
+        )
+    else:
+        image_definitions = dockerfiler.image_definition.ImageDefinitions.from_json(
+            image_definitions_json=sys.stdin.read(),
+            repository_prefix=args.repository_prefix,
+        )
+
+    history = None
+    if args.history_file:
+        history = dockerfiler.history.BuildHistory(args.history_file)
+
+    platform_contexts = {}
+    for platform_context in args.platform_context:
+        platform, separator, context = platform_context.partition("=")
+        if separator == "":
+            raise Exception(
+                f"Expected PLATFORM=CONTEXT for --platform-context, got {platform_context}"
+            )
+
+        platform_contexts[platform] = context
 
     if args.target:
-        repository, tag = args.target.split(":")
-        definition = image_definitions.find_definition(repository, tag)
-        print_instructions_for_tag(
-            definition=definition, tag=tag, destination=f"{repository}:{tag}"
+        run_targets(
+            image_definitions,
+            args.target,
+            history=history,
+            prefetch_parallelism=args.prefetch,
+            platform_contexts=platform_contexts,
         )
     else:
         registry = dockerfiler.registries.get_registry(
@@ -103,4 +514,34 @@ if __name__ == "__main__":
             password=args.registry_password or os.getenv("REGISTRY_PASSWORD"),
         )
 
-        run(registry, image_definitions, should_push=should_push)
+        baseline = None
+        if args.baseline_manifest and not args.verify:
+            with open(args.baseline_manifest) as f:
+                baseline = dockerfiler.image_definition.ImageDefinitions.from_json(
+                    image_definitions_json=f.read(),
+                    repository_prefix=args.repository_prefix,
+                )
+
+        tag_list_cache = None
+        if args.tag_cache_file:
+            tag_list_cache = dockerfiler.registries.TagListCache(
+                args.tag_cache_file, max_age=args.tag_cache_max_age
+            )
+
+        checkpoint_path = args.checkpoint_file
+        if checkpoint_path is None and args.plan_file:
+            checkpoint_path = f"{args.plan_file}.checkpoint"
+
+        run(
+            registry,
+            image_definitions,
+            should_push=should_push,
+            history=history,
+            plan_path=args.plan_file,
+            checkpoint_path=checkpoint_path,
+            resume=args.resume,
+            prefetch_parallelism=args.prefetch,
+            tag_list_cache=tag_list_cache,
+            baseline=baseline,
+            platform_contexts=platform_contexts,
+        )
@@ -0,0 +1,476 @@
+import heapq
+import json
+import os
+import shlex
+import sys
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+import dockerfiler.history
+import dockerfiler.image_definition
+import dockerfiler.registries
+
+
+class Step:
+    """
+    Producing one tag (by building or mirroring) and optionally pushing it. A step for one
+    platform of a multi-platform build produces a tag of its own (see `get_platform_tag`).
+    """
+
+    repository: str
+    tag: str
+    definition: dockerfiler.image_definition.ImageDefinition
+    destination: str
+    should_push: bool
+    platform: Optional[str]
+    dependencies: Set[str]
+    estimated_seconds: Optional[float]
+
+    def __init__(
+        self,
+        repository: str,
+        tag: str,
+        definition: dockerfiler.image_definition.ImageDefinition,
+        destination: str,
+        should_push: bool = False,
+        platform: Optional[str] = None,
+    ):
+        self.repository = repository
+        self.tag = tag
+        self.definition = definition
+        self.destination = destination
+        self.should_push = should_push
+        self.platform = platform
+        self.dependencies = set()
+        self.estimated_seconds = None
+
+    @property
+    def destination_tag(self) -> str:
+        if self.platform is not None:
+            return get_platform_tag(self.tag, self.platform)
+
+        return self.tag
+
+    @property
+    def name(self) -> str:
+        return f"{self.repository}:{self.destination_tag}"
+
+    def get_history_source(self) -> Tuple[str, str]:
+        kind, source = dockerfiler.history.get_step_source(self.definition)
+        if self.platform is not None:
+            source = f"{source} {self.platform}"
+
+        return kind, source
+
+    def get_base_images(self) -> List[str]:
+        return self.definition.get_base_images(self.tag)
+
+    def estimate(self, history: dockerfiler.history.BuildHistory) -> None:
+        kind, source = self.get_history_source()
+        estimates = [history.estimate(kind, self.repository, source)]
+        if self.should_push:
+            estimates.append(history.estimate("push", self.repository))
+
+        if all(x is None for x in estimates):
+            self.estimated_seconds = None
+        else:
+            self.estimated_seconds = sum(x or 0 for x in estimates)
+
+    def print_instructions(
+        self,
+        history: Optional[dockerfiler.history.BuildHistory] = None,
+        docker_context: Optional[str] = None,
+    ) -> None:
+        """
+        `docker_context` names a Docker context (e.g. a native builder for the step's
+        platform) to build and push with, instead of the current one.
+        """
+        kind, source = self.get_history_source()
+        if docker_context is not None:
+            print(f"export DOCKER_CONTEXT={shlex.quote(docker_context)}")
+
+        if history is not None:
+            history.print_timer_start()
+
+        self.definition.print_instructions(
+            tag=self.tag, destination=self.destination, platform=self.platform
+        )
+        if history is not None:
+            history.print_timer_end(kind, self.repository, source)
+
+        if self.should_push:
+            if history is not None:
+                history.print_timer_start()
+
+            print(f"docker push {self.destination}")
+            if history is not None:
+                history.print_timer_end("push", self.repository)
+
+        if docker_context is not None:
+            print("unset DOCKER_CONTEXT")
+
+
+class ManifestListStep(Step):
+    """
+    Assembling and pushing a manifest list for a multi-platform tag, out of images already
+    pushed for each platform (`platform_references`, by tag or digest).
+    """
+
+    platform_references: List[str]
+
+    def __init__(
+        self,
+        repository: str,
+        tag: str,
+        definition: dockerfiler.image_definition.ImageDefinition,
+        destination: str,
+        platform_references: List[str],
+    ):
+        super().__init__(
+            repository=repository,
+            tag=tag,
+            definition=definition,
+            destination=destination,
+            should_push=True,
+        )
+        self.platform_references = platform_references
+
+    def get_history_source(self) -> Tuple[str, str]:
+        return "manifest", ""
+
+    def get_base_images(self) -> List[str]:
+        # What this needs is the images for each platform, which are dependencies already.
+        return []
+
+    def estimate(self, history: dockerfiler.history.BuildHistory) -> None:
+        self.estimated_seconds = history.estimate("manifest", self.repository)
+
+    def print_instructions(
+        self,
+        history: Optional[dockerfiler.history.BuildHistory] = None,
+        docker_context: Optional[str] = None,
+    ) -> None:
+        if history is not None:
+            history.print_timer_start()
+
+        # Creating a manifest list fails if there's a local one left from an earlier attempt.
+        print(f"docker manifest rm {self.destination} 2> /dev/null || true")
+        print(
+            f"docker manifest create {self.destination} {' '.join(self.platform_references)}"
+        )
+        print(f"docker manifest push {self.destination}")
+        if history is not None:
+            history.print_timer_end("manifest", self.repository)
+
+
+def get_platforms(
+    definition: dockerfiler.image_definition.ImageDefinition,
+) -> List[str]:
+    if isinstance(definition, dockerfiler.image_definition.BuildImageDefinition):
+        return definition.platforms
+
+    return []
+
+
+def get_platform_tag(tag: str, platform: str) -> str:
+    """
+    Tag for the image of one platform of a multi-platform tag, e.g. `1.2-linux-arm64`.
+    """
+    return f"{tag}-{platform.replace('/', '-')}"
+
+
+def get_tag_steps(
+    repository: str,
+    tag: str,
+    definition: dockerfiler.image_definition.ImageDefinition,
+    get_destination: Callable[[str], str],
+    should_push: bool = False,
+    existing_tags: Optional[Set[str]] = None,
+    present_platforms: Optional[Dict[str, str]] = None,
+) -> List[Step]:
+    """
+    Steps producing `tag`, which is missing. For a multi-platform build, that's a step for
+    each platform's image, and then (when pushing) a step assembling them into a manifest
+    list. Platforms in `present_platforms` (normalized, and mapped to a reference to their
+    image) and platform tags in `existing_tags` aren't built again.
+    """
+    platforms = get_platforms(definition)
+    if len(platforms) == 0:
+        return [
+            Step(
+                repository=repository,
+                tag=tag,
+                definition=definition,
+                destination=get_destination(tag),
+                should_push=should_push,
+            )
+        ]
+
+    steps: List[Step] = []
+    platform_references = []
+    for platform in platforms:
+        normalized_platform = dockerfiler.registries.normalize_platform(platform)
+        if present_platforms is not None and normalized_platform in present_platforms:
+            platform_references.append(present_platforms[normalized_platform])
+            continue
+
+        step = Step(
+            repository=repository,
+            tag=tag,
+            definition=definition,
+            destination=get_destination(get_platform_tag(tag, platform)),
+            should_push=should_push,
+            platform=platform,
+        )
+        platform_references.append(step.destination)
+        if existing_tags is None or step.destination_tag not in existing_tags:
+            steps.append(step)
+
+    if not should_push:
+        # A manifest list can only be made from images in the registry.
+        return steps
+
+    manifest_list_step = ManifestListStep(
+        repository=repository,
+        tag=tag,
+        definition=definition,
+        destination=get_destination(tag),
+        platform_references=platform_references,
+    )
+    manifest_list_step.dependencies = {x.name for x in steps}
+    return steps + [manifest_list_step]
+
+
+def find_dependencies(steps: List[Step]) -> None:
+    """
+    A step depends on another if it builds from the image that the other one produces.
+    """
+    steps_by_reference = {}
+    for step in steps:
+        steps_by_reference[step.destination] = step
+        steps_by_reference[step.name] = step
+
+    for step in steps:
+        for base_image in step.get_base_images():
+            dependency = steps_by_reference.get(base_image)
+            if dependency is not None and dependency is not step:
+                step.dependencies.add(dependency.name)
+
+
+def get_prefetch_images(steps: List[Step]) -> Dict[Optional[str], List[str]]:
+    """
+    Images that the steps pull in (base images of builds, and mirror sources), by the platform
+    they're needed for (None for steps without one), without duplicates, and leaving out images
+    that are themselves produced by the steps.
+    """
+    produced = {step.destination for step in steps} | {step.name for step in steps}
+    images_by_platform: Dict[Optional[str], List[str]] = {}
+    for step in steps:
+        for image in step.get_base_images():
+            images = images_by_platform.setdefault(step.platform, [])
+            if image not in produced and image not in images:
+                images.append(image)
+
+    return {x: images for x, images in images_by_platform.items() if len(images) > 0}
+
+
+def print_prefetch(
+    images_by_platform: Dict[Optional[str], List[str]],
+    parallelism: int,
+    platform_contexts: Optional[Dict[str, str]] = None,
+) -> None:
+    """
+    Pull images concurrently ahead of the (sequential) steps, so that the network isn't idle
+    between builds. This is only a warm-up: if a pull fails here, the step needing that image
+    will pull it again, and fail there if it must. Images for a platform are pulled for that
+    platform, into the Docker context its steps will run in.
+    """
+    for platform, images in images_by_platform.items():
+        arguments = " ".join(shlex.quote(x) for x in images)
+        xargs = f"xargs -n 1 -P {parallelism} docker pull"
+        if platform is not None:
+            xargs = f"{xargs} --platform {shlex.quote(platform)}"
+            docker_context = (platform_contexts or {}).get(platform)
+            if docker_context is not None:
+                xargs = f"DOCKER_CONTEXT={shlex.quote(docker_context)} {xargs}"
+
+        print(f"printf '%s\\n' {arguments} | {xargs} || true")
+
+
+def order_steps(steps: List[Step]) -> List[Step]:
+    """
+    Order steps longest-first, or rather by the longest chain of work that each step holds up
+    (the critical path through it), so that long builds and the builds they enable start early.
+    Dependencies always come before the steps that need them. Steps without estimates count as
+    taking no time, and ties keep their original order.
+    """
+    steps_by_name = {step.name: step for step in steps}
+    dependents: Dict[str, List[str]] = {step.name: [] for step in steps}
+    for step in steps:
+        for dependency in step.dependencies:
+            dependents[dependency].append(step.name)
+
+    critical_path_seconds: Dict[str, float] = {}
+
+    def get_critical_path_seconds(name: str, visiting: Set[str]) -> float:
+        if name in critical_path_seconds:
+            return critical_path_seconds[name]
+
+        if name in visiting:
+            raise Exception(f"Circular dependency between images involving {name}")
+
+        visiting.add(name)
+        downstream = [get_critical_path_seconds(x, visiting) for x in dependents[name]]
+        visiting.remove(name)
+        critical_path_seconds[name] = (
+            steps_by_name[name].estimated_seconds or 0
+        ) + max(downstream, default=0)
+        return critical_path_seconds[name]
+
+    index = {step.name: i for i, step in enumerate(steps)}
+    remaining_dependencies = {step.name: len(step.dependencies) for step in steps}
+    ready = [
+        (-get_critical_path_seconds(step.name, set()), index[step.name], step.name)
+        for step in steps
+        if remaining_dependencies[step.name] == 0
+    ]
+    heapq.heapify(ready)
+
+    ordered: List[Step] = []
+    while len(ready) > 0:
+        _, _, name = heapq.heappop(ready)
+        ordered.append(steps_by_name[name])
+        for dependent in dependents[name]:
+            remaining_dependencies[dependent] -= 1
+            if remaining_dependencies[dependent] == 0:
+                heapq.heappush(
+                    ready,
+                    (
+                        -get_critical_path_seconds(dependent, set()),
+                        index[dependent],
+                        dependent,
+                    ),
+                )
+
+    if len(ordered) < len(steps):
+        raise Exception("Circular dependency between images")
+
+    return ordered
+
+
+def print_estimates(steps: List[Step]) -> None:
+    for step in steps:
+        print(
+            f"Estimated {dockerfiler.history.format_duration(step.estimated_seconds)} for {step.name}",
+            file=sys.stderr,
+        )
+
+    unknown_count = len([x for x in steps if x.estimated_seconds is None])
+    total = sum(x.estimated_seconds or 0 for x in steps)
+    message = f"Estimated total: {dockerfiler.history.format_duration(total)}"
+    if unknown_count > 0:
+        message += f" (plus {unknown_count} step(s) with no history)"
+
+    print(message, file=sys.stderr)
+
+
+class Checkpoint:
+    """
+    File listing the names of the steps that have completed, one per line. The emitted script
+    appends to it after each step, so that a failed run can be resumed where it stopped.
+    """
+
+    path: str
+    completed: Set[str]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.completed = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.completed = {x.strip() for x in f if x.strip() != ""}
+
+    def print_reset(self) -> None:
+        print(f": > {shlex.quote(self.path)}")
+
+    def print_step_completed(self, step: Step) -> None:
+        print(f"echo {shlex.quote(step.name)} >> {shlex.quote(self.path)}")
+
+
+def save_plan(path: str, steps: List[Step]) -> None:
+    planned_steps = []
+    for step in steps:
+        planned_step: Dict[str, Any] = {
+            "repository": step.repository,
+            "tag": step.tag,
+            "should_push": step.should_push,
+        }
+        if step.platform is not None:
+            planned_step["platform"] = step.platform
+
+        if isinstance(step, ManifestListStep):
+            planned_step["platform_references"] = step.platform_references
+
+        planned_steps.append(planned_step)
+
+    plan = {"steps": planned_steps}
+    with open(path, "w") as f:
+        json.dump(plan, f, indent=2)
+
+
+def load_plan(
+    path: str,
+    image_definitions: dockerfiler.image_definition.ImageDefinitions,
+    registry: dockerfiler.registries.DockerRegistry,
+) -> List[Step]:
+    """
+    Load steps saved by `save_plan`, in their planned order. The definitions for them are
+    looked up in `image_definitions`, so that should be the manifest the plan was made from.
+    """
+    try:
+        with open(path) as f:
+            planned_steps = json.load(f)["steps"]
+    except Exception as e:
+        raise Exception(f"Failed reading plan {path}") from e
+
+    steps: List[Step] = []
+    for planned_step in planned_steps:
+        repository = planned_step["repository"]
+        tag = planned_step["tag"]
+        definition = image_definitions.find_definition(repository, tag)
+        if "platform_references" in planned_step:
+            steps.append(
+                ManifestListStep(
+                    repository=repository,
+                    tag=tag,
+                    definition=definition,
+                    destination=registry.get_full_image_reference(repository, tag),
+                    platform_references=planned_step["platform_references"],
+                )
+            )
+            continue
+
+        platform = planned_step.get("platform")
+        destination_tag = tag
+        if platform is not None:
+            destination_tag = get_platform_tag(tag, platform)
+
+        steps.append(
+            Step(
+                repository=repository,
+                tag=tag,
+                definition=definition,
+                destination=registry.get_full_image_reference(
+                    repository, destination_tag
+                ),
+                should_push=planned_step["should_push"],
+                platform=platform,
+            )
+        )
+
+    return steps
@@ -1,7 +1,18 @@
+import concurrent.futures
+import functools
+import hashlib
+import json
+import math
+import os
+import re
+import time
 import urllib.parse
 from typing import Any
+from typing import Callable
+from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Tuple
 
 import boto3
 import requests
@@ -26,22 +37,260 @@ class DockerRegistry:
     def get_full_image_reference(self, repository: str, tag: str) -> str:
         return f"{self.host}/{repository}:{tag}"
 
+    def get_digest_reference(self, repository: str, digest: str) -> str:
+        return f"{self.host}/{repository}@{digest}"
+
+    def list_platforms_on_tag(
+        self, repository: str, tag: str
+    ) -> Optional[Dict[str, str]]:
+        """
+        Which platforms (normalized, e.g. `linux/arm64/v8`) the image at `repository:tag` is
+        available for, mapped to a reference to each platform's image by digest. None if we
+        can't tell.
+        """
+        return None
+
+
+manifest_media_types = [
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+]
+
+
+def normalize_platform(platform: str) -> str:
+    """
+    Canonical form of a platform string, so that equivalent platforms compare equal, after
+    containerd's `platforms.Normalize`: e.g. `linux/arm64` and `linux/aarch64` become
+    `linux/arm64/v8` (as registries report it), and `linux/amd64/v1` becomes `linux/amd64`.
+    """
+    os_name, _, rest = platform.lower().partition("/")
+    architecture, _, variant = rest.partition("/")
+    if architecture in ("x86_64", "x86-64", "amd64"):
+        architecture = "amd64"
+        if variant == "v1":
+            variant = ""
+    elif architecture in ("aarch64", "arm64"):
+        architecture = "arm64"
+        if variant in ("", "8"):
+            variant = "v8"
+    elif architecture == "arm":
+        if variant in ("", "7"):
+            variant = "v7"
+        elif variant in ("5", "6", "8"):
+            variant = f"v{variant}"
+    elif architecture in ("i386", "386"):
+        architecture = "386"
+
+    return "/".join(x for x in (os_name, architecture, variant) if x != "")
+
+
+def get_platform(platform_data: Dict[str, Any]) -> str:
+    """
+    Platform string from the `os`/`architecture`/`variant` of an image config or manifest list,
+    in normalized form (see `normalize_platform`).
+    """
+    platform = f"{platform_data.get('os')}/{platform_data.get('architecture')}"
+    if platform_data.get("variant"):
+        platform += f"/{platform_data['variant']}"
+
+    return normalize_platform(platform)
+
+
+def get_manifest_platforms(
+    manifest: Dict[str, Any], digest: str, get_config: Callable[[str], Dict[str, Any]],
+) -> Dict[str, str]:
+    """
+    Platforms, mapped to digests, in a manifest list (or OCI index). For a single image
+    manifest, the platform comes from its config blob, fetched by `get_config(config_digest)`.
+    """
+    if "manifests" in manifest:
+        return {
+            get_platform(x.get("platform") or {}): x["digest"]
+            for x in manifest["manifests"]
+            # Attestation manifests aren't images.
+            if (x.get("platform") or {}).get("os") != "unknown"
+        }
+
+    return {get_platform(get_config(manifest["config"]["digest"])): digest}
+
+
+class OCIRegistry(DockerRegistry):
+    """
+    Registry implementing the OCI Distribution API (https://github.com/opencontainers/distribution-spec),
+    e.g. `registry:2`, GHCR, Harbor. Tag listings follow `Link: <...>; rel="next"` pagination.
+
+    When the registry answers with a `WWW-Authenticate: Bearer ...` challenge, we request a token
+    scoped to the repository from the challenge's realm and cache it for subsequent calls on the
+    same repository (until it expires).
+    """
 
-class ArtifactoryRegistry(DockerRegistry):
     host: str
     requests_session: requests.Session
+    credentials: Optional[Tuple[str, str]]
+    tokens: Dict[str, Tuple[str, float]]
 
-    def __init__(self, host: str, username: str, password: str):
+    # Registries may return fewer tags than this per page, but asking for a lot keeps the number
+    # of round trips low on large repositories.
+    page_size = 10000
+
+    def __init__(
+        self, host: str, username: Optional[str] = None, password: Optional[str] = None,
+    ):
         self.host = host
         self.requests_session = requests.Session()
-        self.requests_session.auth = (username, password)
+        self.credentials = None
+        if username is not None and password is not None:
+            self.credentials = (username, password)
+
+        self.tokens = {}
+
+    def get_token(self, scope: str, challenge: Optional[str] = None) -> Optional[str]:
+        """
+        Return a bearer token for `scope`. A cached token is used if it's still valid. Otherwise,
+        if a `WWW-Authenticate` challenge is given, a new token is fetched from its realm.
+        """
+        cached = self.tokens.get(scope)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+
+        if challenge is None or not challenge.lower().startswith("bearer "):
+            return None
+
+        parameters = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = parameters.pop("realm", None)
+        if realm is None:
+            raise Exception(f"Bearer challenge from {self.host} is missing a realm")
+
+        parameters["scope"] = parameters.get("scope") or scope
+        token_response = self.requests_session.get(
+            realm, params=parameters, auth=self.credentials,
+        )
+
+        try:
+            token_response.raise_for_status()
+            token_data = token_response.json()
+            token = token_data.get("token") or token_data["access_token"]
+        except Exception as e:
+            raise Exception(
+                f"Failed to get access token for {scope} from {realm}"
+            ) from e
+
+        # Per the token spec, tokens are valid for 60 seconds unless stated otherwise. Expire
+        # them from the cache a little early so that we never send a stale token.
+        expires_in = int(token_data.get("expires_in") or 60)
+        self.tokens[scope] = (token, time.monotonic() + max(expires_in - 10, 0))
+        return token
+
+    def get(
+        self,
+        repository: str,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> requests.Response:
+        scope = f"repository:{repository}:pull"
+        token = self.get_token(scope)
+        if token is not None:
+            response = self.requests_session.get(
+                url,
+                params=params,
+                headers={**(headers or {}), "authorization": f"Bearer {token}"},
+            )
+        else:
+            response = self.requests_session.get(
+                url, params=params, headers=headers, auth=self.credentials
+            )
+
+        if response.status_code == 401:
+            self.tokens.pop(scope, None)
+            token = self.get_token(
+                scope, challenge=response.headers.get("www-authenticate")
+            )
+            if token is not None:
+                response = self.requests_session.get(
+                    url,
+                    params=params,
+                    headers={**(headers or {}), "authorization": f"Bearer {token}"},
+                )
+
+        return response
 
     def list_tags_on_repository(self, repository: str) -> List[str]:
-        response = self.requests_session.get(
-            f"https://{self.host}/v2/{repository}/tags/list",
+        url: Optional[str] = f"https://{self.host}/v2/{repository}/tags/list"
+        params: Optional[Dict[str, Any]] = {"n": self.page_size}
+        tags: List[str] = []
+        fetched_urls = set()
+        while url is not None:
+            response = self.get(repository, url, params=params)
+            fetched_urls.add(response.url)
+
+            # Repositories are created lazily upon push, so a missing one just has no tags yet.
+            if response.status_code == 404:
+                break
+
+            try:
+                response.raise_for_status()
+                tags += response.json().get("tags") or []
+            except Exception as e:
+                raise Exception(
+                    f"Failed fetching tags for repository {repository} on {self.host}"
+                ) from e
+
+            # The next link carries its own `n` and `last` parameters, and may be relative.
+            next_link = response.links.get("next")
+            url = None
+            params = None
+            if next_link is not None:
+                url = urllib.parse.urljoin(response.url, next_link["url"])
+
+            # Don't loop forever on a registry that links back to a page we've already seen.
+            if url in fetched_urls:
+                break
+
+        return tags
+
+    def list_platforms_on_tag(
+        self, repository: str, tag: str
+    ) -> Optional[Dict[str, str]]:
+        response = self.get(
+            repository,
+            f"https://{self.host}/v2/{repository}/manifests/{tag}",
+            headers={"accept": ", ".join(manifest_media_types)},
         )
 
-        return response.json().get("tags") or []
+        def get_config(config_digest: str) -> Dict[str, Any]:
+            config_response = self.get(
+                repository, f"https://{self.host}/v2/{repository}/blobs/{config_digest}"
+            )
+            config_response.raise_for_status()
+            return config_response.json()
+
+        try:
+            response.raise_for_status()
+            digest = response.headers.get("docker-content-digest")
+            if digest is None:
+                digest = f"sha256:{hashlib.sha256(response.content).hexdigest()}"
+
+            platforms = get_manifest_platforms(response.json(), digest, get_config)
+        except Exception as e:
+            raise Exception(
+                f"Failed fetching manifest for {repository}:{tag} on {self.host}"
+            ) from e
+
+        return {
+            k: self.get_digest_reference(repository, v) for k, v in platforms.items()
+        }
+
+
+class ArtifactoryRegistry(OCIRegistry):
+    """
+    Artifactory implements the OCI Distribution API for Docker repositories, with basic auth.
+    """
+
+    def __init__(self, host: str, username: str, password: str):
+        super().__init__(host=host, username=username, password=password)
 
 
 class DockerHubRegistry(DockerRegistry):
@@ -55,6 +304,9 @@ class DockerHubRegistry(DockerRegistry):
     host: str
     requests_session: requests.Session
 
+    page_size = 1000
+    concurrency = 8
+
     def __init__(self, username: str, password: str):
         self.host = "hub.docker.com"
         self.requests_session = requests.Session()
@@ -73,34 +325,70 @@ class DockerHubRegistry(DockerRegistry):
 
         self.requests_session.headers.update({"authorization": f"JWT {token}"})
 
-    def list_tags_on_repository(self, repository: str) -> List[str]:
-        page_number: Optional[int] = 1
-        tags: List[str] = []
-        while page_number is not None:
-            response = self.requests_session.get(
-                f"https://{self.host}/v2/repositories/{repository}/tags",
-                params={"page": page_number, "page_size": 1000,},
-            )
+    def get_tags_page(self, repository: str, page_number: int) -> Tuple[int, List[str]]:
+        """
+        Returns the total number of tags on the repository, and the tags on this page.
+        """
+        response = self.requests_session.get(
+            f"https://{self.host}/v2/repositories/{repository}/tags",
+            params={"page": page_number, "page_size": self.page_size,},
+        )
 
-            try:
-                result_data = response.json()
-                page_count = int(result_data["count"])
-                tags += [x["name"] for x in result_data["results"]]
-            except Exception as e:
-                raise Exception(
-                    f"Failed fetching tags for Docker Hub repository {repository}"
-                ) from e
+        try:
+            result_data = response.json()
+            return (
+                int(result_data["count"]),
+                [x["name"] for x in result_data["results"]],
+            )
+        except Exception as e:
+            raise Exception(
+                f"Failed fetching tags for Docker Hub repository {repository}"
+            ) from e
 
-            if page_count == 0 or result_data.get("next") is None:
-                page_number = None
-            else:
-                page_number += 1
+    def list_tags_on_repository(self, repository: str) -> List[str]:
+        count, tags = self.get_tags_page(repository, 1)
+        if len(tags) == 0 or len(tags) >= count:
+            return tags
+
+        # The first page tells us how many pages there are (Docker Hub may return fewer tags
+        # per page than we ask for), so fetch the rest of them concurrently.
+        page_count = math.ceil(count / len(tags))
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as executor:
+            pages = executor.map(
+                lambda x: self.get_tags_page(repository, x)[1], range(2, page_count + 1)
+            )
+            for page_tags in pages:
+                tags += page_tags
 
-        return tags
+        return list(dict.fromkeys(tags))
 
     def get_full_image_reference(self, repository: str, tag: str) -> str:
         return f"{repository}:{tag}"
 
+    def get_digest_reference(self, repository: str, digest: str) -> str:
+        return f"{repository}@{digest}"
+
+    def list_platforms_on_tag(
+        self, repository: str, tag: str
+    ) -> Optional[Dict[str, str]]:
+        response = self.requests_session.get(
+            f"https://{self.host}/v2/repositories/{repository}/tags/{tag}",
+        )
+
+        try:
+            response.raise_for_status()
+            images = response.json()["images"]
+        except Exception as e:
+            raise Exception(
+                f"Failed fetching tag details for Docker Hub repository {repository}:{tag}"
+            ) from e
+
+        return {
+            get_platform(x): self.get_digest_reference(repository, x["digest"])
+            for x in images
+            if x.get("digest")
+        }
+
 
 class ECRRegistry(DockerRegistry):
     host: str
@@ -139,6 +427,118 @@ class ECRRegistry(DockerRegistry):
 
         return tags
 
+    def list_platforms_on_tag(
+        self, repository: str, tag: str
+    ) -> Optional[Dict[str, str]]:
+        def get_config(config_digest: str) -> Dict[str, Any]:
+            download = self.ecr.get_download_url_for_layer(
+                repositoryName=repository, layerDigest=config_digest
+            )
+            config_response = requests.get(download["downloadUrl"])
+            config_response.raise_for_status()
+            return config_response.json()
+
+        try:
+            images = self.ecr.batch_get_image(
+                repositoryName=repository,
+                imageIds=[{"imageTag": tag}],
+                acceptedMediaTypes=manifest_media_types,
+            )["images"]
+            platforms = get_manifest_platforms(
+                json.loads(images[0]["imageManifest"]),
+                images[0]["imageId"]["imageDigest"],
+                get_config,
+            )
+        except Exception as e:
+            raise Exception(
+                f"Failed fetching manifest for ECR repository {repository}:{tag}"
+            ) from e
+
+        return {
+            k: self.get_digest_reference(repository, v) for k, v in platforms.items()
+        }
+
+
+class TagListCache:
+    """
+    Persistent cache of tags listed on upstream repositories, used when resolving tag selectors
+    of mirror definitions. A listing is reused until it's `max_age` seconds old.
+    """
+
+    path: str
+    max_age: float
+    listings: Dict[str, Dict[str, Any]]
+
+    def __init__(self, path: str, max_age: float = 3600):
+        self.path = path
+        self.max_age = max_age
+        self.listings = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.listings = json.load(f)
+            except Exception:
+                self.listings = {}
+
+    def get(self, source_reference: str) -> Optional[List[str]]:
+        listing = self.listings.get(source_reference)
+        if listing is None or time.time() - listing["listed_at"] > self.max_age:
+            return None
+
+        return listing["tags"]
+
+    def put(self, source_reference: str, tags: List[str]) -> None:
+        self.listings[source_reference] = {"listed_at": time.time(), "tags": tags}
+
+    def save(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+
+        with open(self.path, "w") as f:
+            json.dump(self.listings, f)
+
+
+docker_hub_hosts = {"docker.io", "index.docker.io", "registry-1.docker.io"}
+
+
+@functools.lru_cache(maxsize=None)
+def get_public_registry(host: str) -> OCIRegistry:
+    """
+    Anonymous access to a registry, shared so that its tokens are reused.
+    """
+    return OCIRegistry(host=host)
+
+
+def get_source_registry(
+    source_reference: str, registry: DockerRegistry
+) -> Tuple[DockerRegistry, str]:
+    """
+    The registry to list tags of a mirror's `source_reference` on, and the repository name
+    there. If the source is on `registry` itself, that's used (with its credentials). Other
+    registries are accessed anonymously through the OCI Distribution API.
+    """
+    host = None
+    repository = source_reference
+    first, _, rest = source_reference.partition("/")
+    if rest != "" and ("." in first or ":" in first or first == "localhost"):
+        host, repository = first, rest
+
+    if host is None or host in docker_hub_hosts:
+        # Official images live under `library/` on Docker Hub.
+        if "/" not in repository:
+            repository = f"library/{repository}"
+
+        if isinstance(registry, DockerHubRegistry):
+            return registry, repository
+
+        return get_public_registry("registry-1.docker.io"), repository
+
+    if host == registry.host:
+        return registry, repository
+
+    return get_public_registry(host), repository
+
 
 def get_registry(
     specification: Optional[str] = None,
@@ -165,6 +565,9 @@ def get_registry(
             host=parsed.netloc, username=username, password=password,
         )
 
+    if parsed.scheme == "oci":
+        return OCIRegistry(host=parsed.netloc, username=username, password=password,)
+
     if parsed.scheme == "ecr":
         return ECRRegistry(host=parsed.netloc,)
 
@@ -0,0 +1,148 @@
+import re
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+Version = Tuple[int, int, int]
+
+version_pattern = re.compile(r"v?(\d+)(?:\.(\d+))?(?:\.(\d+))?")
+comparator_pattern = re.compile(
+    r"(>=|<=|>|<|=|\^|~)?v?(\d+|[xX*])(?:\.(\d+|[xX*]))?(?:\.(\d+|[xX*]))?"
+)
+
+
+def parse_version(tag: str) -> Optional[Version]:
+    """
+    Parse a tag like `1.2.3`, `v1.2` or `1` as a version, with missing parts being zero. Tags
+    with anything else in them (e.g. prereleases like `1.2.3-beta1`, or variants like
+    `1.2.3-alpine`) are not versions.
+    """
+    match = version_pattern.fullmatch(tag)
+    if match is None:
+        return None
+
+    major, minor, patch = match.groups()
+    return (int(major), int(minor or 0), int(patch or 0))
+
+
+def parse_range(semver_range: str) -> List[Tuple[str, Version]]:
+    """
+    Parse a range like `>=0.12 <0.14`, `^1.2`, `~1.2.3` or `1.x` into a list of comparisons
+    that a version must pass, all of them.
+    """
+    comparisons: List[Tuple[str, Version]] = []
+    for comparator in semver_range.split():
+        match = comparator_pattern.fullmatch(comparator)
+        if match is None:
+            raise Exception(f"Invalid semver range {semver_range}")
+
+        operator = match[1] or "="
+        parts = [match[2], match[3], match[4]]
+        specified = []
+        for part in parts:
+            if part is None or not part.isdigit():
+                break
+
+            specified.append(int(part))
+
+        if len(specified) == 0:
+            # `*` or `x` matches everything.
+            continue
+
+        version: Version = (
+            specified[0],
+            specified[1] if len(specified) > 1 else 0,
+            specified[2] if len(specified) > 2 else 0,
+        )
+
+        # The upper bound of a partial version, e.g. `1.2` covers [1.2.0, 1.3.0).
+        upper = (version[0] + 1, 0, 0)
+        if len(specified) == 2:
+            upper = (version[0], version[1] + 1, 0)
+        elif len(specified) == 3:
+            upper = (version[0], version[1], version[2] + 1)
+
+        if operator == "^":
+            # Changes that don't modify the leftmost non-zero part.
+            if version[0] > 0 or len(specified) == 1:
+                upper = (version[0] + 1, 0, 0)
+            elif version[1] > 0 or len(specified) == 2:
+                upper = (0, version[1] + 1, 0)
+
+            comparisons += [(">=", version), ("<", upper)]
+        elif operator == "~":
+            if len(specified) == 1:
+                upper = (version[0] + 1, 0, 0)
+            else:
+                upper = (version[0], version[1] + 1, 0)
+
+            comparisons += [(">=", version), ("<", upper)]
+        elif operator == "=":
+            comparisons += [(">=", version), ("<", upper)]
+        elif operator == ">":
+            comparisons.append((">=", upper))
+        elif operator == "<=":
+            comparisons.append(("<", upper))
+        else:
+            comparisons.append((operator, version))
+
+    return comparisons
+
+
+def compare(version: Version, operator: str, other: Version) -> bool:
+    if operator == ">=":
+        return version >= other
+
+    if operator == "<":
+        return version < other
+
+    raise Exception(f"Unexpected comparison {operator}")
+
+
+class TagSelector:
+    """
+    Selects tags of an upstream repository by regular expression (matching the whole tag)
+    and/or semver range, keeping at most `limit` of them: the highest versions, or the last in
+    sorted order for tags that aren't versions.
+    """
+
+    pattern: Optional[str]
+    semver: Optional[str]
+    limit: Optional[int]
+    comparisons: Optional[List[Tuple[str, Version]]]
+
+    def __init__(
+        self,
+        pattern: Optional[str] = None,
+        semver: Optional[str] = None,
+        limit: Optional[int] = None,
+    ):
+        self.pattern = pattern
+        self.semver = semver
+        self.limit = limit
+        self.comparisons = parse_range(semver) if semver is not None else None
+
+    def matches(self, tag: str) -> bool:
+        if self.pattern is not None and re.fullmatch(self.pattern, tag) is None:
+            return False
+
+        if self.comparisons is not None:
+            version = parse_version(tag)
+            if version is None:
+                return False
+
+            for operator, other in self.comparisons:
+                if not compare(version, operator, other):
+                    return False
+
+        return True
+
+    def select(self, tags: List[str]) -> List[str]:
+        selected = sorted(
+            {x for x in tags if self.matches(x)},
+            key=lambda x: (parse_version(x) or (-1, -1, -1), x),
+        )
+        if self.limit is not None:
+            selected = selected[-self.limit :] if self.limit > 0 else []
+
+        return selected
@@ -3,13 +3,20 @@ import json
 import os
 import re
 import ssl
+import urllib.parse
 from typing import Dict
 from typing import List
+from typing import Optional
+from typing import Tuple
 
 
 class RequestHandler(http.server.BaseHTTPRequestHandler):
     created_repositories: List[str] = []
 
+    # Registries may return fewer tags than requested. Keep pages small so that tests exercise
+    # pagination.
+    tag_page_size = 2
+
     def do_GET(self) -> None:
         host = self.headers["host"]
         print(f"Incoming GET request to {host}{self.path}")
@@ -17,6 +24,10 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
             self.do_artifactory_get()
         elif host == "hub.docker.com":
             self.do_dockerhub_get()
+        elif host == "fake.registry.io":
+            self.do_oci_get()
+        elif host == "api.ecr.us-east-1.amazonaws.com":
+            self.do_ecr_get()
         else:
             self.send_json(404, {"error": f"Invalid request for host {host}"})
 
@@ -35,9 +46,14 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
         else:
             self.send_json(404, {"error": f"Invalid request for host {host}"})
 
-    def send_json(self, status_code: int, data: Dict) -> None:
+    def send_json(
+        self, status_code: int, data: Dict, headers: Optional[Dict[str, str]] = None
+    ) -> None:
         self.send_response(status_code)
         self.send_header("content-type", "application/json")
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+
         self.end_headers()
         self.wfile.write(json.dumps(data).encode("utf8"))
 
@@ -48,6 +64,74 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
         except Exception:
             return []
 
+    def get_platforms(self, repository: str, tag: str) -> List[str]:
+        try:
+            with open(f"data/platforms/{repository}.json") as f:
+                return json.loads(f.read()).get(tag) or ["linux/amd64"]
+        except Exception:
+            return ["linux/amd64"]
+
+    def get_platform_data(self, platform: str) -> Dict[str, str]:
+        """
+        `os`/`architecture`/`variant` as registries report them, e.g. `linux/arm64/v8`
+        """
+        os_name, architecture, *variant = platform.split("/")
+        platform_data = {"os": os_name, "architecture": architecture}
+        if len(variant) > 0:
+            platform_data["variant"] = variant[0]
+
+        return platform_data
+
+    def get_manifest(self, repository: str, tag: str) -> Optional[Tuple[Dict, str]]:
+        """
+        A manifest list for multi-platform tags, or an image manifest (with its config blob
+        at /v2/<repository>/blobs/config-<platform>) otherwise, along with its digest.
+        """
+        if tag not in self.get_tag_list(repository):
+            return None
+
+        platforms = self.get_platforms(repository, tag)
+        if len(platforms) == 1:
+            platform = platforms[0].replace("/", "-")
+            manifest = {
+                "schemaVersion": 2,
+                "mediaType": "application/vnd.oci.image.manifest.v1+json",
+                "config": {"digest": f"config-{platform}"},
+                "layers": [],
+            }
+            return manifest, f"sha256:{tag}-{platform}"
+
+        manifests = []
+        for platform in platforms:
+            manifests.append(
+                {
+                    "digest": f"sha256:{tag}-{platform.replace('/', '-')}",
+                    "platform": self.get_platform_data(platform),
+                }
+            )
+
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.oci.image.index.v1+json",
+            "manifests": manifests,
+        }
+        return manifest, f"sha256:{tag}-index"
+
+    def send_manifest(self, repository: str, tag: str) -> None:
+        manifest = self.get_manifest(repository, tag)
+        if manifest is None:
+            self.send_json(404, {"errors": [{"code": "MANIFEST_UNKNOWN"}]})
+            return
+
+        self.send_json(
+            200, manifest[0], headers={"docker-content-digest": manifest[1]},
+        )
+
+    def send_config(self, config_digest: str) -> None:
+        # Config blobs of the image manifests from `get_manifest`
+        platform = config_digest.split("-", 1)[1].replace("-", "/")
+        self.send_json(200, self.get_platform_data(platform))
+
     def do_artifactory_get(self) -> None:
         match = re.search(r"/v2/(.*)/tags/list", self.path)
         if match is None:
@@ -58,31 +142,111 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
             self.send_json(401, {"error": "basic authorization header required"})
             return
 
-        tag_list = self.get_tag_list(match[1])
-        status_code = 200
+        self.send_tag_list_page(match[1])
+
+    def send_tag_list_page(self, repository: str) -> None:
+        """
+        https://github.com/opencontainers/distribution-spec/blob/main/spec.md#listing-tags
+        """
+        tag_list = sorted(self.get_tag_list(repository))
         if len(tag_list) == 0:
-            status_code = 404
+            self.send_json(404, {"errors": [{"code": "NAME_UNKNOWN"}]})
+            return
 
-        self.send_json(status_code, {"tags": tag_list})
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        page_size = min(int(query.get("n", [len(tag_list)])[0]), self.tag_page_size)
+        if "last" in query:
+            tag_list = [t for t in tag_list if t > query["last"][0]]
 
-    def do_dockerhub_get(self) -> None:
-        match = re.search(r"/v2/repositories/(.*)/tags", self.path)
+        page = tag_list[:page_size]
+        headers: Dict[str, str] = {}
+        if repository == "myuser/looping":
+            # A broken registry whose next link points back at the same page
+            headers["link"] = f'<{self.path}>; rel="next"'
+        elif len(tag_list) > page_size:
+            next_query = urllib.parse.urlencode({"n": page_size, "last": page[-1]})
+            headers["link"] = f'</v2/{repository}/tags/list?{next_query}>; rel="next"'
+
+        self.send_json(200, {"name": repository, "tags": page}, headers=headers)
+
+    def do_oci_get(self) -> None:
+        """
+        Registry using bearer token authentication, cf. https://docs.docker.com/registry/spec/auth/token/
+        """
+        if self.path.startswith("/token?"):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            scope = query.get("scope", [""])[0]
+            self.send_json(200, {"token": f"token:{scope}", "expires_in": 300})
+            return
+
+        match = re.fullmatch(r"/v2/(.*)/(tags/list|manifests/|blobs/)(.*)", self.path)
         if match is None:
-            self.send_json(404, {"error": f"Unexpected request path {self.path}"})
+            self.send_json(404, {"error": "Unexpected request path"})
             return
 
+        scope = f"repository:{match[1]}:pull"
+        if self.headers["authorization"] != f"Bearer token:{scope}":
+            challenge = f'Bearer realm="https://fake.registry.io/token",service="fake.registry.io",scope="{scope}"'
+            self.send_json(
+                401,
+                {"errors": [{"code": "UNAUTHORIZED"}]},
+                headers={"www-authenticate": challenge},
+            )
+            return
+
+        if match[2] == "manifests/":
+            self.send_manifest(match[1], match[3])
+        elif match[2] == "blobs/":
+            self.send_config(match[3])
+        else:
+            self.send_tag_list_page(match[1])
+
+    def do_dockerhub_get(self) -> None:
         if self.headers["authorization"] != "JWT faketoken":
             self.send_json(401, {"error": "authorization header required"})
             return
 
+        tag_match = re.fullmatch(r"/v2/repositories/(.*)/tags/([^/?]+)", self.path)
+        if tag_match is not None:
+            repository, tag = tag_match[1], tag_match[2]
+            if tag not in self.get_tag_list(repository):
+                self.send_json(404, {"message": "tag not found"})
+                return
+
+            images = []
+            for platform in self.get_platforms(repository, tag):
+                digest = f"sha256:{tag}-{platform.replace('/', '-')}"
+                images.append({**self.get_platform_data(platform), "digest": digest})
+
+            self.send_json(200, {"name": tag, "images": images})
+            return
+
+        match = re.search(r"/v2/repositories/(.*)/tags", self.path)
+        if match is None:
+            self.send_json(404, {"error": f"Unexpected request path {self.path}"})
+            return
+
         tag_list = self.get_tag_list(match[1])
         status_code = 200
         if len(tag_list) == 0:
             status_code = 404
 
+        # Like Docker Hub, return fewer tags per page than requested.
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        page_number = int(query.get("page", ["1"])[0])
+        page_size = min(int(query.get("page_size", ["10"])[0]), self.tag_page_size)
+        page = tag_list[(page_number - 1) * page_size : page_number * page_size]
+        next_page = None
+        if page_number * page_size < len(tag_list):
+            next_page = f"https://hub.docker.com{match[0]}?page={page_number + 1}"
+
         self.send_json(
             status_code,
-            {"count": len(tag_list), "results": [{"name": t} for t in tag_list],},
+            {
+                "count": len(tag_list),
+                "next": next_page,
+                "results": [{"name": t} for t in page],
+            },
         )
 
     def do_dockerhub_post(self, data: Dict) -> None:
@@ -100,6 +264,14 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
 
         self.send_json(200, {"token": "faketoken"})
 
+    def do_ecr_get(self) -> None:
+        match = re.fullmatch(r"/layers/(.*)", self.path)
+        if match is None:
+            self.send_json(404, {"error": f"Unexpected request path {self.path}"})
+            return
+
+        self.send_config(match[1])
+
     def do_ecr_post(self, data: Dict) -> None:
         """
         https://docs.aws.amazon.com/AmazonECR/latest/APIReference/ecr-api.pdf
@@ -124,6 +296,32 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
             repository = str(data.get("repositoryName"))
             tag_list = self.get_tag_list(repository)
             self.send_json(200, {"imageDetails": [{"imageTags": tag_list}]})
+        elif target == "BatchGetImage":
+            repository = str(data.get("repositoryName"))
+            tag = data["imageIds"][0]["imageTag"]
+            manifest = self.get_manifest(repository, tag)
+            if manifest is None:
+                failure = {"imageId": {"imageTag": tag}, "failureCode": "ImageNotFound"}
+                self.send_json(200, {"images": [], "failures": [failure]})
+                return
+
+            image = {
+                "repositoryName": repository,
+                "imageId": {"imageDigest": manifest[1], "imageTag": tag},
+                "imageManifest": json.dumps(manifest[0]),
+                "imageManifestMediaType": manifest[0]["mediaType"],
+            }
+            self.send_json(200, {"images": [image], "failures": []})
+        elif target == "GetDownloadUrlForLayer":
+            # Stands in for the pre-signed S3 URL that ECR would return
+            layer_digest = str(data.get("layerDigest"))
+            self.send_json(
+                200,
+                {
+                    "downloadUrl": f"https://api.ecr.us-east-1.amazonaws.com/layers/{layer_digest}",
+                    "layerDigest": layer_digest,
+                },
+            )
         else:
             self.send_json(400, {"error": f"Unexpected request target: {target}"})
 
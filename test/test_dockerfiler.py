@@ -1,11 +1,15 @@
 import contextlib
 import io
 import json
+import os
 import secrets
 import sys
+import tempfile
 import unittest
+import urllib.parse
 
 import dockerfiler.main
+import dockerfiler.history
 import dockerfiler.image_definition
 import dockerfiler.registries
 
@@ -37,6 +41,10 @@ class TestDockerfiler(unittest.TestCase):
             specification="ecr://123123123123.dkr.ecr.us-east-1.amazonaws.com",
         )
 
+        oci_registry = dockerfiler.registries.get_registry(
+            specification="oci://fake.registry.io",
+        )
+
         image_definitions = dockerfiler.image_definition.ImageDefinitions.from_json(
             image_definitions_json=json.dumps(
                 {
@@ -113,6 +121,17 @@ class TestDockerfiler(unittest.TestCase):
                     'docker build -t 123123123123.dkr.ecr.us-east-1.amazonaws.com/myuser/project3:new3.5 -f Dockerfile3 --build-arg TAG="new3.5" .',
                 ],
             },
+            {
+                "description": "interacts properly with an OCI registry",
+                "registry": oci_registry,
+                "expected": [
+                    'docker build -t fake.registry.io/myuser/project1:new1.2 -f Dockerfile1 --build-arg TAG="new1.2" --build-arg FOO_VERSION="x.y.z" .',
+                    'docker build -t fake.registry.io/myuser/project2:new2.2 -f Dockerfile2 --build-arg TAG="new2.2" ./project2-context',
+                    "docker pull somewhere/else:new3.4",
+                    "docker tag somewhere/else:new3.4 fake.registry.io/myuser/project3:new3.4",
+                    'docker build -t fake.registry.io/myuser/project3:new3.5 -f Dockerfile3 --build-arg TAG="new3.5" .',
+                ],
+            },
         ]
 
         for test_case in test_cases:
@@ -201,6 +220,582 @@ class TestDockerfiler(unittest.TestCase):
         ]
         self.assertEqual(output_lines, expected)
 
+    def test_oci_registry(self):
+        """
+        The mock OCI registry pages through tags two at a time and requires a bearer token
+        scoped to each repository.
+        """
+
+        oci_registry = dockerfiler.registries.get_registry(
+            specification="oci://fake.registry.io",
+        )
+
+        with self.subTest("follows pagination"):
+            self.assertEqual(
+                oci_registry.list_tags_on_repository("myuser/project3"),
+                ["old3.1", "old3.2", "old3.3"],
+            )
+
+        with self.subTest("caches tokens per repository"):
+            assert isinstance(oci_registry, dockerfiler.registries.OCIRegistry)
+
+            # Count bearer challenges and token requests made by the registry client.
+            round_trips = {"challenges": 0, "token requests": 0}
+            session_get = oci_registry.requests_session.get
+
+            def counting_get(url, *args, **kwargs):
+                response = session_get(url, *args, **kwargs)
+                if response.status_code == 401:
+                    round_trips["challenges"] += 1
+
+                if urllib.parse.urlparse(url).path == "/token":
+                    round_trips["token requests"] += 1
+
+                return response
+
+            oci_registry.requests_session.get = counting_get  # type: ignore
+            for _ in range(3):
+                oci_registry.list_tags_on_repository("myuser/project1")
+                oci_registry.list_tags_on_repository("myuser/project3")
+
+            # Only myuser/project1 needed a token; myuser/project3's was cached above.
+            self.assertEqual(round_trips, {"challenges": 1, "token requests": 1})
+
+        with self.subTest("stops when pagination links back to a fetched page"):
+            self.assertEqual(
+                oci_registry.list_tags_on_repository("myuser/looping"), ["loop"]
+            )
+
+        with self.subTest("missing repository has no tags"):
+            self.assertEqual(
+                oci_registry.list_tags_on_repository("myuser/newproject"), []
+            )
+
+    def test_build_ordering(self):
+        """
+        Steps are ordered longest-first according to the recorded history, except that an
+        image always comes after the image that it's built from.
+        """
+
+        dockerhub_registry = dockerfiler.registries.get_registry(
+            specification=None, username="z", password="z",
+        )
+
+        with tempfile.TemporaryDirectory() as directory:
+            base_dockerfile = os.path.join(directory, "base.Dockerfile")
+            with open(base_dockerfile, "w") as f:
+                f.write("FROM alpine:3.12\n")
+
+            tool_dockerfile = os.path.join(directory, "tool.Dockerfile")
+            with open(tool_dockerfile, "w") as f:
+                f.write("ARG BASE_TAG=latest\nFROM myuser/newbase:$BASE_TAG\n")
+
+            history_file = os.path.join(directory, "history.jsonl")
+            with open(history_file, "w") as f:
+                for kind, repository, source, seconds in [
+                    ("build", "myuser/newbase", base_dockerfile, 10),
+                    ("build", "myuser/newtool", tool_dockerfile, 600),
+                    ("pull", "myuser/newmirror", "somewhere/else", 300),
+                ]:
+                    record = {
+                        "kind": kind,
+                        "repository": repository,
+                        "source": source,
+                        "seconds": seconds,
+                    }
+                    f.write(json.dumps(record) + "\n")
+
+                # A record cut short by a killed run
+                f.write('{"kind": "build", "repository": "myuser/newbase", "sou')
+
+            image_definitions = dockerfiler.image_definition.ImageDefinitions.from_json(
+                image_definitions_json=json.dumps(
+                    {
+                        "myuser/newmirror": [
+                            {
+                                "type": "mirror",
+                                "source_reference": "somewhere/else",
+                                "tags": {"1": None},
+                            }
+                        ],
+                        "myuser/newbase": [
+                            {
+                                "type": "build",
+                                "dockerfile_path": base_dockerfile,
+                                "tags": {"1": None},
+                            }
+                        ],
+                        "myuser/newtool": [
+                            {
+                                "type": "build",
+                                "dockerfile_path": tool_dockerfile,
+                                "tags": {"1": {"BASE_TAG": "1"}},
+                            }
+                        ],
+                    }
+                ),
+            )
+
+            expected = [
+                f'docker build -t myuser/newbase:1 -f {base_dockerfile} --build-arg TAG="1" .',
+                f'docker build -t myuser/newtool:1 -f {tool_dockerfile} --build-arg TAG="1" --build-arg BASE_TAG="1" .',
+                "docker pull somewhere/else:1",
+                "docker tag somewhere/else:1 myuser/newmirror:1",
+            ]
+
+            with captured_output() as (stdout, stderr):
+                dockerfiler.main.run(
+                    dockerhub_registry,
+                    image_definitions,
+                    history=dockerfiler.history.BuildHistory(history_file),
+                )
+
+            output_lines = [
+                x for x in stdout.getvalue().split("\n") if x.startswith("docker ")
+            ]
+            self.assertEqual(output_lines, expected)
+            assert "Estimated total: 15m10s" in stderr.getvalue()
+            assert "Skipping malformed line 4" in stderr.getvalue()
+
+    def test_prefetch(self):
+        dockerhub_registry = dockerfiler.registries.get_registry(
+            specification=None, username="z", password="z",
+        )
+
+        with tempfile.TemporaryDirectory() as directory:
+            dockerfile = os.path.join(directory, "Dockerfile")
+            with open(dockerfile, "w") as f:
+                f.write(
+                    "ARG PYTHON_VERSION=3.8\n"
+                    "ARG DEBIAN_RELEASE=buster DEBIAN_VARIANT=slim\n"
+                    "ARG GO_VERSION=1.15\n"
+                    "ARG ALPINE_VERSION\n"
+                    "FROM python:$PYTHON_VERSION AS builder\n"
+                    "FROM alpine:${ALPINE_VERSION}\n"
+                    "FROM debian:${DEBIAN_RELEASE}-${DEBIAN_VARIANT}\n"
+                    # Re-declaring an argument within a stage doesn't change it for FROM.
+                    "ARG GO_VERSION\n"
+                    "ARG PYTHON_VERSION=2.7\n"
+                    "FROM golang:$GO_VERSION\n"
+                    "FROM node:${NODE_VERSION:-14}${NODE_VARIANT:+-slim}\n"
+                    "FROM myuser/newbase:1\n"
+                    "COPY --from=builder /a /a\n"
+                )
+
+            image_definitions = dockerfiler.image_definition.ImageDefinitions.from_json(
+                image_definitions_json=json.dumps(
+                    {
+                        "myuser/newbase": [
+                            {
+                                "type": "mirror",
+                                "source_reference": "somewhere/else",
+                                "tags": {"1": None},
+                            }
+                        ],
+                        "myuser/newtool": [
+                            {
+                                "type": "build",
+                                "dockerfile_path": dockerfile,
+                                "tags": {
+                                    "1": {"PYTHON_VERSION": "3.9"},
+                                    "2": {"PYTHON_VERSION": "3.9"},
+                                    "3": None,
+                                },
+                            }
+                        ],
+                    }
+                ),
+            )
+
+            with captured_output() as (stdout, stderr):
+                dockerfiler.main.run(
+                    dockerhub_registry, image_definitions, prefetch_parallelism=4,
+                )
+
+            output_lines = stdout.getvalue().split("\n")
+            self.assertEqual(
+                output_lines[1],
+                "printf '%s\\n' somewhere/else:1 python:3.8 debian:buster-slim golang:1.15 node:14 python:3.9 | xargs -n 1 -P 4 docker pull || true",
+            )
+
+            # Base images of platform builds are pulled for their platform, in the context
+            # their steps will run in.
+            image_definitions = dockerfiler.image_definition.ImageDefinitions.from_json(
+                image_definitions_json=json.dumps(
+                    {
+                        "myuser/multiarch": [
+                            {
+                                "type": "build",
+                                "dockerfile_path": dockerfile,
+                                "platforms": ["linux/amd64", "linux/arm64"],
+                                "tags": {"3": None},
+                            }
+                        ],
+                    }
+                ),
+            )
+
+            with captured_output() as (stdout, stderr):
+                dockerfiler.main.run(
+                    dockerhub_registry,
+                    image_definitions,
+                    prefetch_parallelism=4,
+                    platform_contexts={"linux/arm64": "arm-builder"},
+                )
+
+            output_lines = stdout.getvalue().split("\n")
+            self.assertEqual(
+                output_lines[1:3],
+                [
+                    "printf '%s\\n' python:3.8 debian:buster-slim golang:1.15 node:14 myuser/newbase:1 | xargs -n 1 -P 4 docker pull --platform linux/amd64 || true",
+                    "printf '%s\\n' python:3.8 debian:buster-slim golang:1.15 node:14 myuser/newbase:1 | DOCKER_CONTEXT=arm-builder xargs -n 1 -P 4 docker pull --platform linux/arm64 || true",
+                ],
+            )
+
+    def test_tag_selector(self):
+        dockerhub_registry = dockerfiler.registries.get_registry(
+            specification=None, username="z", password="z",
+        )
+
+        def get_image_definitions():
+            return dockerfiler.image_definition.ImageDefinitions.from_json(
+                image_definitions_json=json.dumps(
+                    {
+                        "myuser/terraform": [
+                            {
+                                "type": "mirror",
+                                "source_reference": "hashicorp/terraform",
+                                "tags": {"light": None},
+                                "tag_selector": {"semver": "^0.12", "limit": 2},
+                            }
+                        ],
+                    }
+                ),
+            )
+
+        expected = [
+            "docker pull hashicorp/terraform:light",
+            "docker tag hashicorp/terraform:light myuser/terraform:light",
+            "docker pull hashicorp/terraform:0.12.28",
+            "docker tag hashicorp/terraform:0.12.28 myuser/terraform:0.12.28",
+            "docker pull hashicorp/terraform:0.12.29",
+            "docker tag hashicorp/terraform:0.12.29 myuser/terraform:0.12.29",
+        ]
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache_path = os.path.join(directory, "tags.json")
+
+            with self.subTest("selects tags listed upstream"):
+                with captured_output() as (stdout, stderr):
+                    dockerfiler.main.run(
+                        dockerhub_registry,
+                        get_image_definitions(),
+                        tag_list_cache=dockerfiler.registries.TagListCache(cache_path),
+                    )
+
+                output_lines = [
+                    x for x in stdout.getvalue().split("\n") if x.startswith("docker ")
+                ]
+                self.assertEqual(output_lines, expected)
+
+            with self.subTest("reuses cached upstream listings"):
+                with open(cache_path) as f:
+                    listings = json.load(f)
+
+                listings["hashicorp/terraform"]["tags"].append("0.12.30")
+                with open(cache_path, "w") as f:
+                    json.dump(listings, f)
+
+                with captured_output() as (stdout, stderr):
+                    dockerfiler.main.run(
+                        dockerhub_registry,
+                        get_image_definitions(),
+                        tag_list_cache=dockerfiler.registries.TagListCache(cache_path),
+                    )
+
+                assert "docker pull hashicorp/terraform:0.12.30" in stdout.getvalue()
+                assert (
+                    "docker pull hashicorp/terraform:0.12.28" not in stdout.getvalue()
+                )
+
+        with self.subTest("matches tags without listing upstream"):
+            definition = get_image_definitions().find_definition(
+                "myuser/terraform", "0.12.99"
+            )
+            assert isinstance(
+                definition, dockerfiler.image_definition.MirrorImageDefinition
+            )
+
+        with self.subTest("accepts a range matching every version"):
+            image_definitions = dockerfiler.image_definition.ImageDefinitions.from_json(
+                image_definitions_json=json.dumps(
+                    {
+                        "myuser/terraform": [
+                            {
+                                "type": "mirror",
+                                "source_reference": "hashicorp/terraform",
+                                "tag_selector": {"semver": "*", "limit": 2},
+                            }
+                        ],
+                    }
+                ),
+            )
+            definition = image_definitions["myuser/terraform"][0]
+            assert isinstance(
+                definition, dockerfiler.image_definition.MirrorImageDefinition
+            )
+            assert definition.tag_selector is not None
+            self.assertEqual(
+                definition.tag_selector.select(
+                    ["0.11.14", "0.12.29", "0.13.0", "light"]
+                ),
+                ["0.12.29", "0.13.0"],
+            )
+
+    def test_baseline_manifest(self):
+        """
+        Tags unchanged since the baseline are taken to be in the registry already (even if
+        they're not, like `new1.2` and `new2.2` here), and only changed repositories are
+        inspected.
+        """
+
+        dockerhub_registry = dockerfiler.registries.get_registry(
+            specification=None, username="z", password="z",
+        )
+
+        baseline = {
+            "myuser/project1": [
+                {
+                    "type": "build",
+                    "dockerfile_path": "Dockerfile1",
+                    "tags": {"old1.1": None, "new1.2": None},
+                }
+            ],
+            "myuser/project2": [
+                {
+                    "type": "build",
+                    "dockerfile_path": "Dockerfile2",
+                    "tags": {"old2.1": None, "new2.2": None, "new2.3": None},
+                }
+            ],
+        }
+        manifest = json.loads(json.dumps(baseline))
+        manifest["myuser/project2"][0]["tags"]["new2.3"] = {"FOO_VERSION": "x.y.z"}
+        manifest["myuser/project2"][0]["tags"]["new2.4"] = None
+
+        expected = [
+            'docker build -t myuser/project2:new2.3 -f Dockerfile2 --build-arg TAG="new2.3" --build-arg FOO_VERSION="x.y.z" .',
+            'docker build -t myuser/project2:new2.4 -f Dockerfile2 --build-arg TAG="new2.4" .',
+        ]
+
+        with captured_output() as (stdout, stderr):
+            dockerfiler.main.run(
+                dockerhub_registry,
+                dockerfiler.image_definition.ImageDefinitions.from_json(
+                    image_definitions_json=json.dumps(manifest)
+                ),
+                baseline=dockerfiler.image_definition.ImageDefinitions.from_json(
+                    image_definitions_json=json.dumps(baseline)
+                ),
+            )
+
+        output_lines = [
+            x for x in stdout.getvalue().split("\n") if x.startswith("docker ")
+        ]
+        self.assertEqual(sorted(output_lines), expected)
+        assert "1 of 2 repositories changed" in stderr.getvalue()
+
+    def test_resume(self):
+        dockerhub_registry = dockerfiler.registries.get_registry(
+            specification=None, username="z", password="z",
+        )
+
+        image_definitions = dockerfiler.image_definition.ImageDefinitions.from_json(
+            image_definitions_json=json.dumps(
+                {
+                    "myuser/project1": [
+                        {
+                            "type": "build",
+                            "dockerfile_path": "Dockerfile1",
+                            "tags": {"old1.1": None, "new1.2": None, "new1.3": None},
+                        }
+                    ],
+                    "myuser/project2": [
+                        {
+                            "type": "build",
+                            "dockerfile_path": "Dockerfile2",
+                            "tags": {"new2.2": None},
+                        }
+                    ],
+                }
+            ),
+        )
+
+        with tempfile.TemporaryDirectory() as directory:
+            plan_path = os.path.join(directory, "plan.json")
+            checkpoint_path = os.path.join(directory, "checkpoint")
+
+            with self.subTest("saves the plan and records completed steps"):
+                with captured_output() as (stdout, stderr):
+                    dockerfiler.main.run(
+                        dockerhub_registry,
+                        image_definitions,
+                        should_push=True,
+                        plan_path=plan_path,
+                        checkpoint_path=checkpoint_path,
+                    )
+
+                output_lines = stdout.getvalue().split("\n")
+                assert f": > {checkpoint_path}" in output_lines
+                assert (
+                    f"echo myuser/project2:new2.2 >> {checkpoint_path}" in output_lines
+                )
+                with open(plan_path) as f:
+                    self.assertEqual(
+                        [x["tag"] for x in json.load(f)["steps"]],
+                        ["new1.2", "new1.3", "new2.2"],
+                    )
+
+            with self.subTest("skips completed steps and steps now in the registry"):
+                # Pretend that `old1.1` was planned, but got pushed before the run failed.
+                with open(plan_path, "w") as f:
+                    planned_tags = [
+                        ("myuser/project1", "new1.2"),
+                        ("myuser/project1", "old1.1"),
+                        ("myuser/project1", "new1.3"),
+                        ("myuser/project2", "new2.2"),
+                    ]
+                    steps = [
+                        {"repository": r, "tag": t, "should_push": True}
+                        for r, t in planned_tags
+                    ]
+                    json.dump({"steps": steps}, f)
+
+                with open(checkpoint_path, "w") as f:
+                    f.write("myuser/project1:new1.2\n")
+
+                expected = [
+                    'docker build -t myuser/project1:new1.3 -f Dockerfile1 --build-arg TAG="new1.3" .',
+                    "docker push myuser/project1:new1.3",
+                    'docker build -t myuser/project2:new2.2 -f Dockerfile2 --build-arg TAG="new2.2" .',
+                    "docker push myuser/project2:new2.2",
+                ]
+
+                with captured_output() as (stdout, stderr):
+                    dockerfiler.main.run(
+                        dockerhub_registry,
+                        image_definitions,
+                        plan_path=plan_path,
+                        checkpoint_path=checkpoint_path,
+                        resume=True,
+                    )
+
+                output_lines = [
+                    x for x in stdout.getvalue().split("\n") if x.startswith("docker ")
+                ]
+                self.assertEqual(output_lines, expected)
+                assert ": >" not in stdout.getvalue()
+
+    def test_platforms(self):
+        """
+        In the mock registries, `myuser/multiarch:1` has both platforms, while
+        `myuser/multiarch:2` is only there for linux/amd64 (but `2-linux-arm64` was already
+        pushed). `myuser/multiarch:4` has both, with arm64 reported as `linux/arm64/v8`.
+        """
+
+        image_definitions = dockerfiler.image_definition.ImageDefinitions.from_json(
+            image_definitions_json=json.dumps(
+                {
+                    "myuser/multiarch": [
+                        {
+                            "type": "build",
+                            "dockerfile_path": "Dockerfile",
+                            "platforms": ["linux/amd64", "linux/arm64"],
+                            "tags": {"1": None, "2": None, "3": None, "4": None},
+                        }
+                    ],
+                }
+            ),
+        )
+
+        test_cases = [
+            {
+                "description": "with an OCI registry",
+                "registry": dockerfiler.registries.get_registry(
+                    specification="oci://fake.registry.io",
+                ),
+                "expected": [
+                    "docker manifest rm fake.registry.io/myuser/multiarch:2 2> /dev/null || true",
+                    "docker manifest create fake.registry.io/myuser/multiarch:2 fake.registry.io/myuser/multiarch@sha256:2-linux-amd64 fake.registry.io/myuser/multiarch:2-linux-arm64",
+                    "docker manifest push fake.registry.io/myuser/multiarch:2",
+                    'docker build --platform linux/amd64 -t fake.registry.io/myuser/multiarch:3-linux-amd64 -f Dockerfile --build-arg TAG="3" .',
+                    "docker push fake.registry.io/myuser/multiarch:3-linux-amd64",
+                    "export DOCKER_CONTEXT=arm-builder",
+                    'docker build --platform linux/arm64 -t fake.registry.io/myuser/multiarch:3-linux-arm64 -f Dockerfile --build-arg TAG="3" .',
+                    "docker push fake.registry.io/myuser/multiarch:3-linux-arm64",
+                    "unset DOCKER_CONTEXT",
+                    "docker manifest rm fake.registry.io/myuser/multiarch:3 2> /dev/null || true",
+                    "docker manifest create fake.registry.io/myuser/multiarch:3 fake.registry.io/myuser/multiarch:3-linux-amd64 fake.registry.io/myuser/multiarch:3-linux-arm64",
+                    "docker manifest push fake.registry.io/myuser/multiarch:3",
+                ],
+            },
+            {
+                "description": "with ECR",
+                "registry": dockerfiler.registries.get_registry(
+                    specification="ecr://123123123123.dkr.ecr.us-east-1.amazonaws.com",
+                ),
+                "expected": [
+                    "docker manifest rm 123123123123.dkr.ecr.us-east-1.amazonaws.com/myuser/multiarch:2 2> /dev/null || true",
+                    "docker manifest create 123123123123.dkr.ecr.us-east-1.amazonaws.com/myuser/multiarch:2 123123123123.dkr.ecr.us-east-1.amazonaws.com/myuser/multiarch@sha256:2-linux-amd64 123123123123.dkr.ecr.us-east-1.amazonaws.com/myuser/multiarch:2-linux-arm64",
+                    "docker manifest push 123123123123.dkr.ecr.us-east-1.amazonaws.com/myuser/multiarch:2",
+                    'docker build --platform linux/amd64 -t 123123123123.dkr.ecr.us-east-1.amazonaws.com/myuser/multiarch:3-linux-amd64 -f Dockerfile --build-arg TAG="3" .',
+                    "docker push 123123123123.dkr.ecr.us-east-1.amazonaws.com/myuser/multiarch:3-linux-amd64",
+                    "export DOCKER_CONTEXT=arm-builder",
+                    'docker build --platform linux/arm64 -t 123123123123.dkr.ecr.us-east-1.amazonaws.com/myuser/multiarch:3-linux-arm64 -f Dockerfile --build-arg TAG="3" .',
+                    "docker push 123123123123.dkr.ecr.us-east-1.amazonaws.com/myuser/multiarch:3-linux-arm64",
+                    "unset DOCKER_CONTEXT",
+                    "docker manifest rm 123123123123.dkr.ecr.us-east-1.amazonaws.com/myuser/multiarch:3 2> /dev/null || true",
+                    "docker manifest create 123123123123.dkr.ecr.us-east-1.amazonaws.com/myuser/multiarch:3 123123123123.dkr.ecr.us-east-1.amazonaws.com/myuser/multiarch:3-linux-amd64 123123123123.dkr.ecr.us-east-1.amazonaws.com/myuser/multiarch:3-linux-arm64",
+                    "docker manifest push 123123123123.dkr.ecr.us-east-1.amazonaws.com/myuser/multiarch:3",
+                ],
+            },
+            {
+                "description": "with Docker Hub",
+                "registry": dockerfiler.registries.get_registry(
+                    specification=None, username="z", password="z",
+                ),
+                "expected": [
+                    "docker manifest rm myuser/multiarch:2 2> /dev/null || true",
+                    "docker manifest create myuser/multiarch:2 myuser/multiarch@sha256:2-linux-amd64 myuser/multiarch:2-linux-arm64",
+                    "docker manifest push myuser/multiarch:2",
+                    'docker build --platform linux/amd64 -t myuser/multiarch:3-linux-amd64 -f Dockerfile --build-arg TAG="3" .',
+                    "docker push myuser/multiarch:3-linux-amd64",
+                    "export DOCKER_CONTEXT=arm-builder",
+                    'docker build --platform linux/arm64 -t myuser/multiarch:3-linux-arm64 -f Dockerfile --build-arg TAG="3" .',
+                    "docker push myuser/multiarch:3-linux-arm64",
+                    "unset DOCKER_CONTEXT",
+                    "docker manifest rm myuser/multiarch:3 2> /dev/null || true",
+                    "docker manifest create myuser/multiarch:3 myuser/multiarch:3-linux-amd64 myuser/multiarch:3-linux-arm64",
+                    "docker manifest push myuser/multiarch:3",
+                ],
+            },
+        ]
+
+        for test_case in test_cases:
+            with self.subTest(test_case["description"]):
+                with captured_output() as (stdout, stderr):
+                    dockerfiler.main.run(
+                        test_case["registry"],
+                        image_definitions,
+                        should_push=True,
+                        platform_contexts={"linux/arm64": "arm-builder"},
+                    )
+
+                output_lines = stdout.getvalue().split("\n")[1:-1]
+                self.assertEqual(output_lines, test_case["expected"])
+                assert "myuser/multiarch:2 is missing platforms" in stderr.getvalue()
+                assert "myuser/multiarch:4" not in stderr.getvalue()
+
     def test_create_new_repository(self):
         host = "123123123123.dkr.ecr.us-east-1.amazonaws.com"
         ecr_registry = dockerfiler.registries.get_registry(
@@ -238,6 +833,64 @@ class TestDockerfiler(unittest.TestCase):
         ]
         self.assertEqual(output_lines, expected)
 
+    def test_targets(self):
+        image_definitions = dockerfiler.image_definition.ImageDefinitions.from_json(
+            image_definitions_json=json.dumps(
+                {
+                    "team-x/tool1": [
+                        {
+                            "type": "build",
+                            "dockerfile_path": "Dockerfile1",
+                            "tags": {"1.0": None, "2.0": None, "2.1": None},
+                        }
+                    ],
+                    "team-x/tool2": [
+                        {
+                            "type": "mirror",
+                            "source_reference": "somewhere/else",
+                            "tags": {"2.0": None},
+                        }
+                    ],
+                    "team-y/tool3": [
+                        {
+                            "type": "build",
+                            "dockerfile_path": "Dockerfile3",
+                            "tags": {"3": None, "4": None},
+                        }
+                    ],
+                }
+            ),
+        )
+
+        expected = [
+            'docker build -t team-x/tool1:2.0 -f Dockerfile1 --build-arg TAG="2.0" .',
+            'docker build -t team-x/tool1:2.1 -f Dockerfile1 --build-arg TAG="2.1" .',
+            "docker pull somewhere/else:2.0",
+            "docker tag somewhere/else:2.0 team-x/tool2:2.0",
+            'docker build -t team-y/tool3:3 -f Dockerfile3 --build-arg TAG="3" .',
+            'docker build -t team-y/tool3:4 -f Dockerfile3 --build-arg TAG="4" .',
+        ]
+
+        with captured_output() as (stdout, stderr):
+            dockerfiler.main.run_targets(
+                image_definitions, ["team-x/*:2.*", "team-y/tool3", "team-x/tool1:2.1"],
+            )
+
+        output_lines = [
+            x for x in stdout.getvalue().split("\n") if x.startswith("docker ")
+        ]
+        self.assertEqual(output_lines, expected)
+
+        for target in ["team-z/*", "team-x/tool1:3.0"]:
+            with self.subTest(f"rejects {target}"):
+                exception = None
+                try:
+                    image_definitions.select(target)
+                except Exception as e:
+                    exception = e
+
+                assert exception is not None
+
     def test_invalid_input(self):
         """
         There's no need to exhaustively specify the schema here (we can rely on the tests
@@ -262,6 +915,128 @@ class TestDockerfiler(unittest.TestCase):
 
                 assert exception is not None
 
+    def test_manifest_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            manifest_directory = os.path.join(directory, "manifests")
+            os.makedirs(os.path.join(manifest_directory, "team2"))
+            manifests = {
+                "team1.json": {
+                    "project1": [
+                        {
+                            "type": "build",
+                            "dockerfile_path": "Dockerfile1",
+                            "tags": {"1": None},
+                        }
+                    ],
+                },
+                "team2/a.json": {
+                    "project2": [
+                        {
+                            "type": "mirror",
+                            "source_reference": "somewhere/else",
+                            "tags": {"2": None},
+                        }
+                    ],
+                },
+                "team2/b.json": {
+                    "project3": [
+                        {
+                            "type": "build",
+                            "dockerfile_path": "Dockerfile3",
+                            "tags": {"3": None},
+                        }
+                    ],
+                },
+            }
+            for name, manifest in manifests.items():
+                with open(os.path.join(manifest_directory, name), "w") as f:
+                    json.dump(manifest, f)
+
+            cache_path = os.path.join(directory, "cache", "manifests.json")
+
+            with self.subTest("merges files"):
+                image_definitions = dockerfiler.image_definition.ImageDefinitions.from_directory(
+                    manifest_directory,
+                    repository_prefix="myuser/",
+                    cache=dockerfiler.image_definition.ManifestCache(cache_path),
+                )
+                self.assertEqual(
+                    sorted(image_definitions.keys()),
+                    ["myuser/project1", "myuser/project2", "myuser/project3"],
+                )
+
+            with self.subTest("skips validating unchanged files"):
+                # Change the contents without changing the size or modification time. The
+                # cache can't tell, which shows that the file wasn't parsed again.
+                path = os.path.join(manifest_directory, "team1.json")
+                stat = os.stat(path)
+                with open(path) as f:
+                    contents = f.read()
+
+                with open(path, "w") as f:
+                    f.write(contents.replace("Dockerfile1", "DockerfileX"))
+
+                os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                image_definitions = dockerfiler.image_definition.ImageDefinitions.from_directory(
+                    manifest_directory,
+                    cache=dockerfiler.image_definition.ManifestCache(cache_path),
+                )
+                definition = image_definitions.find_definition("project1", "1")
+                assert isinstance(
+                    definition, dockerfiler.image_definition.BuildImageDefinition
+                )
+                self.assertEqual(definition.dockerfile_path, "Dockerfile1")
+
+            with self.subTest("ignores a cache written by another version"):
+                with open(cache_path) as f:
+                    cached = json.load(f)
+
+                cached["version"] = 0
+                with open(cache_path, "w") as f:
+                    json.dump(cached, f)
+
+                image_definitions = dockerfiler.image_definition.ImageDefinitions.from_directory(
+                    manifest_directory,
+                    cache=dockerfiler.image_definition.ManifestCache(cache_path),
+                )
+                definition = image_definitions.find_definition("project1", "1")
+                assert isinstance(
+                    definition, dockerfiler.image_definition.BuildImageDefinition
+                )
+                self.assertEqual(definition.dockerfile_path, "DockerfileX")
+
+            with self.subTest("forgets deleted files"):
+                os.remove(os.path.join(manifest_directory, "team2", "b.json"))
+                dockerfiler.image_definition.ImageDefinitions.from_directory(
+                    manifest_directory,
+                    cache=dockerfiler.image_definition.ManifestCache(cache_path),
+                )
+                with open(cache_path) as f:
+                    cached = json.load(f)
+
+                self.assertEqual(
+                    sorted(
+                        os.path.relpath(x, manifest_directory)
+                        for x in cached["entries"]
+                    ),
+                    ["team1.json", os.path.join("team2", "a.json")],
+                )
+
+            with self.subTest("rejects a repository defined in more than one file"):
+                with open(os.path.join(manifest_directory, "team3.json"), "w") as f:
+                    json.dump(manifests["team1.json"], f)
+
+                exception = None
+                try:
+                    dockerfiler.image_definition.ImageDefinitions.from_directory(
+                        manifest_directory
+                    )
+                except Exception as e:
+                    exception = e
+
+                assert exception is not None
+                assert "Repository project1 is defined in both" in str(exception)
+
     def test_authorization_failure(self):
         with self.subTest("missing credentials"):
             exception = None